@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Сравнение скорости записи ответов: старые триггеры против write_answer_batch"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import main
+
+LEGACY_TRIGGERS = [
+    '''
+    CREATE TRIGGER update_user_level_after_insert
+    AFTER INSERT ON task_history
+    FOR EACH ROW
+    BEGIN
+        UPDATE users 
+        SET current_level = (
+            SELECT 
+                CASE 
+                    WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.85 THEN 5
+                    WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.75 THEN 4
+                    WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.60 THEN 3
+                    WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.40 THEN 2
+                    ELSE 1
+                END
+            FROM users 
+            WHERE user_id = NEW.user_id
+        )
+        WHERE user_id = NEW.user_id 
+        AND (
+            (SELECT total_tasks FROM users WHERE user_id = NEW.user_id) % 5 = 0
+            OR 
+            (SELECT COUNT(*) FROM task_history 
+             WHERE user_id = NEW.user_id 
+             AND timestamp > datetime('now', '-1 hour')) = 0
+        );
+    END;
+    ''',
+    '''
+    CREATE TRIGGER update_topic_progress_after_insert
+    AFTER INSERT ON task_history
+    FOR EACH ROW
+    BEGIN
+        INSERT OR REPLACE INTO topic_progress (user_id, topic, tasks_solved, correct_rate, last_solved)
+        VALUES (
+            NEW.user_id,
+            NEW.task_topic,
+            COALESCE((SELECT tasks_solved + 1 FROM topic_progress 
+                     WHERE user_id = NEW.user_id AND topic = NEW.task_topic), 1),
+            COALESCE((SELECT (correct_rate * tasks_solved + CASE WHEN NEW.correct THEN 1.0 ELSE 0.0 END) / (tasks_solved + 1)
+                     FROM topic_progress 
+                     WHERE user_id = NEW.user_id AND topic = NEW.task_topic),
+                     CASE WHEN NEW.correct THEN 1.0 ELSE 0.0 END),
+            NEW.timestamp
+        );
+    END;
+    ''',
+    '''
+    CREATE TRIGGER update_user_activity
+    AFTER INSERT ON task_history
+    FOR EACH ROW
+    BEGIN
+        UPDATE users 
+        SET last_activity = CURRENT_TIMESTAMP
+        WHERE user_id = NEW.user_id;
+    END;
+    ''',
+]
+
+
+def make_events(count, users, tasks):
+    rng = random.Random(42)
+    return [
+        (rng.randrange(1, users + 1), rng.choice(tasks)['id'], rng.random() < 0.7, rng.randint(10, 300))
+        for _ in range(count)
+    ]
+
+
+def use_database(path):
+    main.close_connections()
+    main.DB_NAME = path
+    main.init_database()
+
+
+def bench_legacy(path, events):
+    """Прежний путь: по одной транзакции на ответ и три триггера на вставку"""
+    use_database(path)
+    with main.transaction() as cursor:
+        for sql in LEGACY_TRIGGERS:
+            cursor.execute(sql)
+
+    conn = main.get_connection()
+    start = time.perf_counter()
+    for user_id, task_id, is_correct, time_spent in events:
+        task = main.task_catalog.get(task_id)
+        with main.transaction() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO users (user_id, current_level) VALUES (?, 1)", (user_id,))
+            cursor.execute('''
+                INSERT INTO task_history 
+                (user_id, task_id, task_topic, correct, difficulty, time_spent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, task_id, task['topic'], is_correct, main.task_difficulty(task), time_spent))
+            cursor.execute('''
+                UPDATE users 
+                SET total_tasks = total_tasks + 1,
+                    correct_answers = correct_answers + ?
+                WHERE user_id = ?
+            ''', (1 if is_correct else 0, user_id))
+    elapsed = time.perf_counter() - start
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return elapsed
+
+
+def bench_batch(path, events, batch_size):
+    """Новый путь: write_answer_batch пачками по batch_size; ведет еще user_task_summary и дневные агрегаты"""
+    use_database(path)
+    start = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        main.write_answer_batch(events[i:i + batch_size])
+    return time.perf_counter() - start
+
+
+def bench_writer(path, events):
+    """Путь бота: каждый ответ отдельно отправляется в AnswerWriter, тот пишет их общими пачками"""
+    use_database(path)
+    writer = main.AnswerWriter()
+    start = time.perf_counter()
+    futures = [writer.submit(*event) for event in events]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    writer.stop()
+    return elapsed
+
+
+def run_benchmark(count=2000, users=200):
+    tasks = main.task_catalog.tasks
+    if not tasks:
+        print("Каталог заданий пуст, бенчмарк невозможен")
+        return 1
+
+    events = make_events(count, users, tasks)
+    original_db_name = main.DB_NAME
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        results.append(("Триггеры, 1 ответ на транзакцию",
+                        bench_legacy(os.path.join(tmp, "legacy.db"), events)))
+        results.append(("write_answer_batch, 1 ответ",
+                        bench_batch(os.path.join(tmp, "single.db"), events, 1)))
+        results.append((f"write_answer_batch, пачки по {main.ANSWER_BATCH_SIZE}",
+                        bench_batch(os.path.join(tmp, "batch.db"), events, main.ANSWER_BATCH_SIZE)))
+        results.append(("AnswerWriter, ответы по одному",
+                        bench_writer(os.path.join(tmp, "writer.db"), events)))
+        main.close_connections()
+    main.DB_NAME = original_db_name
+
+    print(f"\nВставка {count} ответов для {users} пользователей (SQLite {sqlite3.sqlite_version})")
+    print("=" * 70)
+    print(f"{'Путь записи':<45} {'сек':>8} {'вставок/сек':>14}")
+    print("-" * 70)
+    for name, elapsed in results:
+        print(f"{name:<45} {elapsed:>8.3f} {count / elapsed:>14.0f}")
+    print("=" * 70)
+    return 0
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    sys.exit(run_benchmark(count))
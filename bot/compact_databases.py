@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Однократный перевод баз, созданных до включения auto_vacuum, в режим INCREMENTAL.
+
+Полный VACUUM держит базу заблокированной, пока перезаписывает файл: запускать при остановленном боте.
+"""
+
+import main
+
+INCREMENTAL = 2
+
+
+def compact_database(db_name):
+    conn = main.open_connection(db_name)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == INCREMENTAL:
+            print(f"{db_name}: уже в режиме INCREMENTAL")
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        print(f"{db_name}: переведена в режим INCREMENTAL")
+        return True
+    finally:
+        conn.close()
+
+
+def compact_databases():
+    return sum(compact_database(db_name) for db_name in main.all_db_names())
+
+
+if __name__ == "__main__":
+    print(f"Переведено баз: {compact_databases()}")
+    main.close_connections()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Потоковая выгрузка task_history, users и topic_progress в сжатые JSONL/CSV"""
+
+import csv
+import gzip
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime
+
+import main
+
+# таблица: (колонка водяного знака, вид водяного знака, порядок строк).
+# users и topic_progress отбираются по updated_at - времени изменения строки;
+# last_activity и last_solved - время ответов, пересчет импортом их не сдвигает
+EXPORT_TABLES = {
+    "task_history": ("id", "id", "id"),
+    "users": ("updated_at", "time", "user_id"),
+    "topic_progress": ("updated_at", "time", "user_id, topic"),
+}
+
+# updated_at ставится до COMMIT: строка, записанная транзакцией, которая завершилась
+# после среза выгрузки, может получить время меньше водяного знака. Поэтому строки
+# по времени перечитываются с запасом дольше любой пишущей транзакции, а уже
+# выгруженные отбрасываются по хешу
+EXPORT_TIME_OVERLAP = 300
+
+
+def get_watermark(conn, table):
+    row = conn.execute(
+        "SELECT last_value, overlap_rows FROM export_watermarks WHERE table_name = ?", (table,)
+    ).fetchone()
+    if row is None:
+        return None, set()
+    return row[0], set(json.loads(row[1])) if row[1] else set()
+
+
+def save_watermark(db_name, table, value, boundary=None):
+    with main.transaction(db_name) as cursor:
+        cursor.execute('''
+            INSERT INTO export_watermarks (table_name, last_value, exported_at, overlap_rows)
+            VALUES (?, ?, CURRENT_TIMESTAMP, ?)
+            ON CONFLICT (table_name) DO UPDATE SET
+                last_value = excluded.last_value,
+                exported_at = excluded.exported_at,
+                overlap_rows = excluded.overlap_rows
+        ''', (table, value, json.dumps(sorted(boundary)) if boundary is not None else None))
+
+
+def row_hash(record):
+    return hashlib.md5(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def stream_rows(conn, table, since):
+    """Строки читаются курсором по одной, без fetchall"""
+    column, kind, order = EXPORT_TABLES[table]
+    sql = f"SELECT * FROM {table}"
+    params = ()
+    if since is not None and kind == "id":
+        # id выдается под блокировкой записи и строго растет
+        sql += f" WHERE {column} > ?"
+        params = (int(since),)
+    elif since is not None:
+        sql += f" WHERE {column} >= datetime(?, ?)"
+        params = (since, f"-{EXPORT_TIME_OVERLAP} seconds")
+    cursor = conn.execute(f"{sql} ORDER BY {order}", params)
+    columns = [description[0] for description in cursor.description]
+    for row in cursor:
+        yield dict(zip(columns, row))
+
+
+def skip_exported(records, exported_rows):
+    for record in records:
+        if row_hash(record) not in exported_rows:
+            yield record
+
+
+def overlap_rows(conn, table, watermark):
+    """Хеши строк у новой границы: следующая выгрузка перечитает их и пропустит"""
+    column = EXPORT_TABLES[table][0]
+    return {
+        row_hash(record)
+        for record in stream_rows(conn, table, watermark)
+        if record[column] is not None
+    }
+
+
+def track_max(records, column, state):
+    for record in records:
+        value = record[column]
+        if value is not None and (state["max"] is None or value > state["max"]):
+            state["max"] = value
+        yield record
+
+
+def write_jsonl(records, f):
+    count = 0
+    for record in records:
+        f.write(json.dumps(record, ensure_ascii=False))
+        f.write("\n")
+        count += 1
+    return count
+
+
+def write_csv(records, f):
+    count = 0
+    writer = None
+    for record in records:
+        if writer is None:
+            writer = csv.DictWriter(f, fieldnames=list(record))
+            writer.writeheader()
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+WRITERS = {"jsonl": write_jsonl, "csv": write_csv}
+
+
+def export_table(db_name, table, out_dir, fmt="jsonl", full=False, suffix=""):
+    column, kind, _ = EXPORT_TABLES[table]
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(out_dir, f"{table}{suffix}_{stamp}.{fmt}.gz")
+    tmp_path = f"{path}.tmp"
+
+    conn = main.open_connection(db_name)
+    try:
+        since, exported_rows = get_watermark(conn, table)
+        if full:
+            since, exported_rows = None, set()
+        # Одна читающая транзакция: согласованный срез, писатели в WAL не ждут
+        conn.execute("BEGIN")
+        state = {"max": None}
+        records = stream_rows(conn, table, since)
+        if kind != "id":
+            records = skip_exported(records, exported_rows)
+        records = track_max(records, column, state)
+        with gzip.open(tmp_path, "wt", encoding="utf-8", newline="") as f:
+            count = WRITERS[fmt](records, f)
+        boundary = None
+        if count and kind != "id" and state["max"] is not None:
+            # Водяной знак - время самой поздней выгруженной строки, а не часы
+            # выгрузки; граница считается в том же срезе
+            boundary = overlap_rows(conn, table, state["max"])
+        conn.execute("COMMIT")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        conn.close()
+
+    if count == 0:
+        os.remove(tmp_path)
+        return None, 0
+
+    # Водяной знак сдвигается только после того, как файл полностью записан
+    os.replace(tmp_path, path)
+    if kind == "id":
+        save_watermark(db_name, table, str(state["max"]))
+    elif state["max"] is not None:
+        save_watermark(db_name, table, state["max"], boundary)
+    return path, count
+
+
+def export_all(out_dir, fmt="jsonl", full=False):
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+    exported = {}
+    for index, db_name in enumerate(main.shard_names()):
+        suffix = f"_shard{index}" if main.SHARD_COUNT > 1 else ""
+        for table in EXPORT_TABLES:
+            path, count = export_table(db_name, table, out_dir, fmt, full, suffix)
+            exported[(table, db_name)] = count
+            if path:
+                print(f"{table}{suffix}: {count} строк -> {path}")
+            else:
+                print(f"{table}{suffix}: новых строк нет")
+    return exported
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Использование: python export_data.py <каталог> [jsonl|csv] [--full]")
+        sys.exit(1)
+    fmt = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else "jsonl"
+    export_all(sys.argv[1], fmt, full="--full" in sys.argv)
+    main.close_connections()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""Массовый импорт истории ответов из JSONL/CSV в task_history"""
+
+import csv
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import main
+
+IMPORT_CHUNK_SIZE = 50000
+# Пересчет итогов идет порциями пользователей: каждая порция - короткая транзакция,
+# и запущенный бот продолжает записывать ответы между ними
+RECOMPUTE_CHUNK_USERS = 500
+# Сколько отклоненных записей выводится с причиной; остальные только считаются
+REJECT_LOG_LIMIT = 20
+
+TRUE_VALUES = ("1", "true", "yes", "да")
+FALSE_VALUES = ("0", "false", "no", "нет")
+
+
+def open_source(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_records(path):
+    """Построчное чтение файла: в памяти одна запись, а не весь файл"""
+    name = path[:-3] if path.endswith(".gz") else path
+    with open_source(path) as f:
+        if name.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"не логическое значение: {value!r}")
+
+
+def parse_int(value):
+    """Целое без округления: 12.5 отклоняется, а не превращается в 12"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"не целое число: {value!r}")
+
+
+def parse_record(record):
+    """Запись файла -> строка task_history; ValueError с причиной, если запись неполная или некорректная"""
+    try:
+        user_id = parse_int(record["user_id"])
+        task_id = str(record["task_id"])
+        timestamp = datetime.fromisoformat(str(record["timestamp"]).replace("Z", "+00:00"))
+
+        task = main.task_catalog.get(task_id)
+        topic = task["topic"] if task else record.get("topic")
+        difficulty = main.task_difficulty(task) if task else record.get("difficulty")
+        if not topic or difficulty in (None, ""):
+            raise ValueError(f"неизвестное задание {task_id} без темы и сложности")
+        difficulty = parse_int(difficulty)
+
+        time_spent = record.get("time_spent")
+        time_spent = parse_int(time_spent) if time_spent not in (None, "") else None
+        correct = parse_bool(record["correct"])
+    except KeyError as e:
+        raise ValueError(f"нет поля {e}")
+    except TypeError as e:
+        raise ValueError(str(e))
+
+    # В базе время в UTC, как у CURRENT_TIMESTAMP; время без пояса считается уже UTC
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    stamp = timestamp.replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        user_id, task_id, topic, correct, difficulty,
+        time_spent, stamp, stamp[:10]
+    )
+
+
+def insert_chunk(rows):
+    shard_rows = {}
+    for row in rows:
+        shard_rows.setdefault(main.shard_db_name(row[0]), []).append(row)
+    for db_name, batch in shard_rows.items():
+        with main.transaction(db_name) as cursor:
+            # Строка users нужна для внешнего ключа; итоги заполнит пересчет
+            cursor.executemany(
+                "INSERT OR IGNORE INTO users (user_id, current_level, updated_at) VALUES (?, 1, CURRENT_TIMESTAMP)",
+                [(user_id,) for user_id in dict.fromkeys(row[0] for row in batch)]
+            )
+            cursor.executemany('''
+                INSERT INTO task_history
+                (user_id, task_id, task_topic, correct, difficulty, time_spent, timestamp, day)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+
+
+def recompute_users(db_name, user_ids):
+    """Пересчет users, topic_progress и user_task_summary для затронутых пользователей"""
+    for start in range(0, len(user_ids), RECOMPUTE_CHUNK_USERS):
+        recompute_chunk(db_name, user_ids[start:start + RECOMPUTE_CHUNK_USERS])
+
+
+def recompute_chunk(db_name, user_ids):
+    history = "SELECT user_id, task_id, task_topic, correct, timestamp FROM main.task_history"
+    conn = main.open_connection(db_name)
+    try:
+        # Заархивированные строки тоже входят в итоги пользователя
+        archive = main.archive_db_name(db_name)
+        if os.path.exists(archive):
+            conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+            history += (" UNION ALL SELECT user_id, task_id, task_topic, correct, timestamp"
+                        " FROM archive.task_history")
+
+        conn.execute("CREATE TEMP TABLE imported_users (user_id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO imported_users VALUES (?)", [(user_id,) for user_id in user_ids])
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f'''
+                INSERT INTO users (user_id, total_tasks, correct_answers, current_level, last_activity, updated_at)
+                SELECT user_id, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END), 1, MAX(timestamp),
+                       CURRENT_TIMESTAMP
+                FROM ({history})
+                WHERE user_id IN (SELECT user_id FROM imported_users)
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    total_tasks = excluded.total_tasks,
+                    correct_answers = excluded.correct_answers,
+                    last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity),
+                    updated_at = excluded.updated_at
+            ''')
+            conn.executemany(
+                "UPDATE users SET current_level = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                [
+                    (main.calculate_level(correct_answers, total_tasks), user_id)
+                    for user_id, correct_answers, total_tasks in conn.execute('''
+                        SELECT user_id, correct_answers, total_tasks FROM users
+                        WHERE user_id IN (SELECT user_id FROM imported_users)
+                    ''').fetchall()
+                ]
+            )
+
+            conn.execute(f'''
+                INSERT INTO topic_progress (user_id, topic, tasks_solved, correct_rate, last_solved, updated_at)
+                SELECT user_id, task_topic, COUNT(*),
+                       AVG(CASE WHEN correct THEN 1.0 ELSE 0.0 END), MAX(timestamp), CURRENT_TIMESTAMP
+                FROM ({history})
+                WHERE user_id IN (SELECT user_id FROM imported_users) AND task_topic IS NOT NULL
+                GROUP BY user_id, task_topic
+                ON CONFLICT (user_id, topic) DO UPDATE SET
+                    tasks_solved = excluded.tasks_solved,
+                    correct_rate = excluded.correct_rate,
+                    last_solved = excluded.last_solved,
+                    updated_at = excluded.updated_at
+            ''')
+
+            conn.execute("DELETE FROM user_task_summary WHERE user_id IN (SELECT user_id FROM imported_users)")
+            conn.execute(f'''
+                INSERT INTO user_task_summary (user_id, task_id, attempts, correct, last_seen)
+                SELECT user_id, task_id, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END), MAX(timestamp)
+                FROM ({history})
+                WHERE user_id IN (SELECT user_id FROM imported_users)
+                GROUP BY user_id, task_id
+            ''')
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def import_history(path, chunk_size=IMPORT_CHUNK_SIZE):
+    imported = 0
+    rejected = 0
+    user_ids = set()
+    chunk = []
+    for number, record in enumerate(read_records(path), 1):
+        try:
+            row = parse_record(record)
+        except ValueError as e:
+            rejected += 1
+            if rejected <= REJECT_LOG_LIMIT:
+                print(f"Запись {number} отклонена: {e}")
+            continue
+        chunk.append(row)
+        user_ids.add(row[0])
+        if len(chunk) >= chunk_size:
+            insert_chunk(chunk)
+            imported += len(chunk)
+            chunk = []
+            print(f"Импортировано строк: {imported}")
+    if chunk:
+        insert_chunk(chunk)
+        imported += len(chunk)
+
+    for db_name, shard_user_ids in main.group_by_shard(sorted(user_ids)).items():
+        recompute_users(db_name, shard_user_ids)
+    # Сбрасывается кэш профилей только этого процесса: запущенный бот отдает
+    # профили, прочитанные до импорта, пока не истечет USER_PROFILE_CACHE_TTL
+    main.user_profile_cache.invalidate(user_ids)
+    # Дневные агрегаты и представления пересчитываются целиком одним проходом
+    main.rebuild_materialized_views()
+
+    print(f"Импорт завершен: {imported} строк, {len(user_ids)} пользователей, отклонено {rejected}")
+    print(f"Запущенный бот увидит новые итоги в течение {main.USER_PROFILE_CACHE_TTL} сек")
+    return imported, rejected
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Использование: python import_history.py <файл.jsonl|файл.csv[.gz]> [размер_порции]")
+        sys.exit(1)
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else IMPORT_CHUNK_SIZE
+    import_history(sys.argv[1], chunk_size)
+    main.close_connections()
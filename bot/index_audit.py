@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Аудит индексов task_history: какие индексы используют запросы бота и сколько стоит каждый при вставке"""
+
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+import main
+
+INDEX_PATTERN = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+STATEMENT_PATTERN = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_query(sql):
+    """Текст запроса без литералов: одинаковые запросы с разными параметрами сливаются"""
+    return " ".join(LITERAL_PATTERN.sub("?", sql).split())
+
+
+def run_workload(users=50, answers=1000):
+    """Прогон всех запросов, которые выполняет бот, на тестовой базе"""
+    tasks = main.task_catalog.tasks
+    rng = random.Random(1)
+    user_ids = list(range(1, users + 1))
+    events = [
+        (rng.choice(user_ids), rng.choice(tasks)['id'], rng.random() < 0.7, rng.randint(10, 300))
+        for _ in range(answers)
+    ]
+    for i in range(0, len(events), main.ANSWER_BATCH_SIZE):
+        main.write_answer_batch(events[i:i + main.ANSWER_BATCH_SIZE])
+
+    for user_id in user_ids[:5]:
+        main.get_user_stats(user_id)
+        main.get_topic_stats(user_id)
+        main.get_task_summary(user_id)
+        main.get_recent_results(user_id)
+        main.get_user_daily_stats(user_id)
+        main.get_adaptive_task(user_id)
+    main.rank_tasks_batch(user_ids, 3)
+    main.get_leaderboard()
+    main.refresh_materialized_views()
+    main.get_top_users()
+    main.get_topic_global_stats(tasks[0]['topic'])
+    main.rebuild_materialized_views()
+
+
+def capture_queries():
+    statements = {}
+
+    def tracer(sql):
+        if STATEMENT_PATTERN.match(sql) and 'sqlite_master' not in sql:
+            statements.setdefault(normalize_query(sql), sql)
+
+    main.close_connections()
+    main.QUERY_TRACER = tracer
+    try:
+        run_workload()
+    finally:
+        main.QUERY_TRACER = None
+        main.close_connections()
+    return list(statements.values())
+
+
+def explain(conn, statements):
+    """EXPLAIN QUERY PLAN для каждого запроса: индекс -> число запросов, которые его используют"""
+    usage = {}
+    plans = []
+    for sql in statements:
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        except sqlite3.Error as e:
+            print(f"Не удалось разобрать запрос: {e}")
+            continue
+        plans.append((sql, plan))
+        for line in plan:
+            for index_name in INDEX_PATTERN.findall(line):
+                usage[index_name] = usage.get(index_name, 0) + 1
+    return usage, plans
+
+
+def history_indexes(conn):
+    return conn.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'task_history' AND sql IS NOT NULL
+    ''').fetchall()
+
+
+def measure_insert_cost(table_sql, indexes, rows=20000, repeats=3):
+    """Время вставки rows строк без индексов и с каждым индексом по отдельности (лучшее из repeats)"""
+    rng = random.Random(2)
+    data = [
+        (rng.randint(1, 500), str(rng.randint(1, 30)), f"Тема {rng.randint(1, 10)}",
+         rng.random() < 0.7, rng.randint(1, 5), rng.randint(10, 300))
+        for _ in range(rows)
+    ]
+
+    def timed(index_sql):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = main.open_connection(os.path.join(tmp, "bench.db"))
+            # Таблицы users здесь нет, внешний ключ не проверяется
+            conn.execute("PRAGMA foreign_keys = OFF")
+            conn.execute(table_sql)
+            if index_sql:
+                conn.execute(index_sql)
+            start = time.perf_counter()
+            for i in range(0, rows, 100):
+                conn.execute("BEGIN")
+                conn.executemany('''
+                    INSERT INTO task_history (user_id, task_id, task_topic, correct, difficulty, time_spent, day)
+                    VALUES (?, ?, ?, ?, ?, ?, date('now'))
+                ''', data[i:i + 100])
+                conn.execute("COMMIT")
+            elapsed = time.perf_counter() - start
+            conn.close()
+            return elapsed
+
+    def best(index_sql):
+        return min(timed(index_sql) for _ in range(repeats))
+
+    baseline = best(None)
+    return baseline, {name: best(sql) - baseline for name, sql in indexes}
+
+
+def run_audit(verbose=False):
+    if not main.task_catalog.tasks:
+        print("Каталог заданий пуст, аудит невозможен")
+        return 1
+
+    original_db_name = main.DB_NAME
+    with tempfile.TemporaryDirectory() as tmp:
+        main.close_connections()
+        main.DB_NAME = os.path.join(tmp, "audit.db")
+        main.init_database()
+        statements = capture_queries()
+
+        conn = sqlite3.connect(main.DB_NAME)
+        usage, plans = explain(conn, statements)
+        indexes = history_indexes(conn)
+        table_sql = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'task_history'"
+        ).fetchone()[0]
+        conn.close()
+    main.DB_NAME = original_db_name
+
+    rows = 20000
+    baseline, costs = measure_insert_cost(table_sql, indexes, rows)
+
+    if verbose:
+        for sql, plan in plans:
+            print(normalize_query(sql)[:120])
+            for line in plan:
+                print(f"    {line}")
+
+    print(f"\nЗапросов проанализировано: {len(plans)}")
+    print(f"Вставка без вторичных индексов: {baseline / rows * 1e6:.1f} мкс/строка")
+    print("=" * 80)
+    print(f"{'Индекс task_history':<40} {'запросов':>10} {'+мкс/вставка':>14} {'вывод':>12}")
+    print("-" * 80)
+    for name, _ in indexes:
+        used = usage.get(name, 0)
+        verdict = "нужен" if used else "не нужен"
+        print(f"{name:<40} {used:>10} {costs[name] / rows * 1e6:>14.1f} {verdict:>12}")
+    print("=" * 80)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_audit(verbose="-v" in sys.argv))
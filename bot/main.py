@@ -6,8 +6,14 @@ import re
 import sqlite3
 import threading
 import hashlib
+import time
+import functools
 import aiohttp
-from datetime import datetime
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import FSInputFile
@@ -18,11 +24,213 @@ bot = Bot(token="")
 dp = Dispatcher()
 
 DB_NAME = "users_stats.db"
+# Персональные таблицы пользователей (users, task_history, topic_progress и их сводки)
+# делятся на SHARD_COUNT файлов по user_id; общие агрегаты остаются в DB_NAME.
+# При SHARD_COUNT = 1 единственный шард - это сам DB_NAME. Смена числа шардов
+# на существующих данных требует их переноса.
+SHARD_COUNT = 1
+ADMIN_IDS = set()
+
+SQLITE_PRAGMAS = {
+    # до создания таблиц: архивация освобождает место через incremental_vacuum
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'cache_size': -16000,  # в KiB, около 16 МБ на соединение
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+# Необязательный обработчик трассировки SQL для диагностики (index_audit.py)
+QUERY_TRACER = None
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_connections_generation = 0
+
+
+def open_connection(db_name):
+    conn = sqlite3.connect(db_name, isolation_level=None, check_same_thread=False)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if QUERY_TRACER is not None:
+        conn.set_trace_callback(QUERY_TRACER)
+    return conn
+
+
+def get_connection(db_name=None):
+    db_name = db_name or DB_NAME
+    if getattr(_local, 'generation', None) != _connections_generation:
+        _local.connections = {}
+        _local.generation = _connections_generation
+
+    conn = _local.connections.get(db_name)
+    if conn is None:
+        conn = open_connection(db_name)
+        _local.connections[db_name] = conn
+        with _connections_lock:
+            # Соединения завершившихся потоков больше никто не использует
+            for thread, old_conn in [item for item in _connections if not item[0].is_alive()]:
+                old_conn.close()
+                _connections.remove((thread, old_conn))
+            _connections.append((threading.current_thread(), conn))
+    return conn
+
+
+def close_connections():
+    global _connections_generation
+    with _connections_lock:
+        for _, conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+        _connections_generation += 1
+        for conn, _ in _snapshot_sources.values():
+            conn.close()
+        _snapshot_sources.clear()
+
+
+@contextmanager
+def transaction(db_name=None):
+    conn = get_connection(db_name)
+    if conn.in_transaction:
+        # Вложенный вызов выполняется в рамках внешней транзакции
+        yield conn.cursor()
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def shard_names():
+    if SHARD_COUNT <= 1:
+        return [DB_NAME]
+    base, ext = os.path.splitext(DB_NAME)
+    return [f"{base}_shard{i}{ext or '.db'}" for i in range(SHARD_COUNT)]
+
+
+def all_db_names():
+    return list(dict.fromkeys([DB_NAME] + shard_names()))
+
+
+def shard_db_name(user_id):
+    return shard_names()[int(user_id) % max(SHARD_COUNT, 1)]
+
+
+def group_by_shard(user_ids):
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_db_name(user_id), []).append(user_id)
+    return groups
+
+
+def query_shards(sql, params=(), analytics=False):
+    # Один и тот же запрос ко всем шардам; объединяет и сортирует результат вызывающий.
+    # analytics=True читает из аналитических снимков, а не из рабочих баз
+    rows = []
+    for db_name in shard_names():
+        if analytics:
+            rows.extend(analytics_query(sql, params, db_name))
+        else:
+            rows.extend(get_connection(db_name).execute(sql, params).fetchall())
+    return rows
+
+
+# Тяжелые агрегирующие чтения идут в копию базы, снятую через backup API,
+# и не конкурируют с записью ответов. Снимок старше ANALYTICS_SNAPSHOT_MAX_AGE
+# не используется: такие запросы читают рабочую базу. Копирование - O(размер базы),
+# поэтому неизменившаяся база не копируется, а интервал выбирается по ее размеру
+ANALYTICS_SNAPSHOT_INTERVAL = 300
+ANALYTICS_SNAPSHOT_MAX_AGE = 900
+
+# Соединения, через которые снимаются копии: PRAGMA data_version одного соединения
+# меняется, только если базу изменил кто-то другой. {db_name: [соединение, версия]}
+_snapshot_sources = {}
+
+
+def analytics_db_name(db_name=None):
+    base, ext = os.path.splitext(db_name or DB_NAME)
+    return f"{base}_analytics{ext or '.db'}"
+
+
+def take_analytics_snapshot():
+    taken = 0
+    for db_name in all_db_names():
+        snapshot = analytics_db_name(db_name)
+        tmp_path = f"{snapshot}.tmp"
+        try:
+            source = _snapshot_sources.get(db_name)
+            if source is None:
+                source = _snapshot_sources[db_name] = [open_connection(db_name), None]
+            conn, last_version = source
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == last_version and os.path.exists(snapshot):
+                # База не менялась с прошлой копии: снимок по-прежнему точен
+                os.utime(snapshot)
+                continue
+
+            target = sqlite3.connect(tmp_path)
+            try:
+                # Копия делается за один шаг: в режиме WAL это одна читающая
+                # транзакция, которая не мешает писателям и дает согласованный снимок
+                conn.backup(target)
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+            # Уже открытые читатели дочитывают прежний файл
+            os.replace(tmp_path, snapshot)
+            source[1] = version
+            taken += 1
+        except (sqlite3.Error, OSError) as e:
+            print(f"Ошибка снятия аналитического снимка {db_name}: {e}")
+            # Следующая попытка открывает соединение заново и делает полную копию
+            source = _snapshot_sources.pop(db_name, None)
+            if source is not None:
+                source[0].close()
+    return taken
+
+
+def analytics_connection(db_name=None):
+    path = analytics_db_name(db_name)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    if age > ANALYTICS_SNAPSHOT_MAX_AGE:
+        return None
+    # Файл снимка не меняется, он только подменяется целиком
+    return sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+
+
+def analytics_query(sql, params=(), db_name=None):
+    conn = analytics_connection(db_name)
+    if conn is None:
+        return get_connection(db_name).execute(sql, params).fetchall()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
 
 
 def init_database():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # Схема одинакова во всех файлах: так миграции применяются к ним без различий
+    for db_name in all_db_names():
+        with transaction(db_name) as cursor:
+            create_schema(cursor)
+        drop_legacy_triggers(db_name)
+
+
+def create_schema(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -31,9 +239,12 @@ def init_database():
             correct_answers INTEGER DEFAULT 0,
             current_level INTEGER DEFAULT 1,
             last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- время изменения строки (export_data.py)
         )
     ''')
+    # ALTER TABLE не добавляет колонку с DEFAULT CURRENT_TIMESTAMP; пишущий код задает ее сам
+    ensure_column(cursor, 'users', 'updated_at', 'TIMESTAMP')
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS topic_progress (
@@ -43,10 +254,12 @@ def init_database():
             tasks_solved INTEGER DEFAULT 0,
             correct_rate REAL DEFAULT 0,
             last_solved TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
             UNIQUE(user_id, topic)
         )
     ''')
+    ensure_column(cursor, 'topic_progress', 'updated_at', 'TIMESTAMP')
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS task_history (
@@ -58,62 +271,133 @@ def init_database():
             difficulty INTEGER,
             time_spent INTEGER DEFAULT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            day TEXT,  -- DATE(timestamp), хранится для группировки по дням
             FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
         )
     ''')
+    ensure_column(cursor, 'task_history', 'day', 'TEXT')
 
+    # Свертка заархивированных строк task_history по (пользователь, день, тема)
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS materialized_views (
-            view_name TEXT PRIMARY KEY,
-            last_refresh TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            data TEXT
+        CREATE TABLE IF NOT EXISTS task_history_rollup (
+            user_id INTEGER,
+            day TEXT,
+            topic TEXT DEFAULT '',
+            attempts INTEGER DEFAULT 0,
+            correct INTEGER DEFAULT 0,
+            difficulty_sum INTEGER DEFAULT 0,
+            time_spent_sum INTEGER DEFAULT 0,
+            time_spent_count INTEGER DEFAULT 0,
+            first_seen TIMESTAMP,
+            last_seen TIMESTAMP,
+            PRIMARY KEY (user_id, day, topic)
         )
     ''')
 
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS schema_migrations (
-            version TEXT PRIMARY KEY,
-            description TEXT,
-            checksum TEXT,
-            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS user_task_summary (
+            user_id INTEGER,
+            task_id TEXT,
+            attempts INTEGER DEFAULT 0,
+            correct INTEGER DEFAULT 0,
+            last_seen TIMESTAMP,
+            PRIMARY KEY (user_id, task_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
         )
     ''')
+
+    # Дневные агрегаты, которые обновляются дельтами при каждой записи ответов
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_user_time 
-        ON task_history(user_id, timestamp DESC)
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            user_id INTEGER,
+            day TEXT,
+            tasks_per_day INTEGER DEFAULT 0,
+            correct_per_day INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
     ''')
 
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_user_correct_time 
-        ON task_history(user_id, correct, timestamp)
+        CREATE TABLE IF NOT EXISTS daily_topic_stats (
+            topic TEXT,
+            day TEXT,
+            total_attempts INTEGER DEFAULT 0,
+            correct_attempts INTEGER DEFAULT 0,
+            difficulty_sum INTEGER DEFAULT 0,
+            PRIMARY KEY (topic, day)
+        )
     ''')
 
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_user_task_time 
-        ON task_history(user_id, task_id, timestamp DESC)
+        CREATE INDEX IF NOT EXISTS idx_daily_user_stats_day
+        ON daily_user_stats(day)
     ''')
+
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_correct_true 
-        ON task_history(user_id, timestamp) 
-        WHERE correct = 1
+        CREATE TABLE IF NOT EXISTS topic_global_stats (
+            topic TEXT PRIMARY KEY,
+            total_attempts INTEGER DEFAULT 0,
+            correct_attempts INTEGER DEFAULT 0,
+            global_success_rate REAL DEFAULT 0,
+            avg_difficulty REAL DEFAULT 0
+        )
     ''')
 
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_correct_false 
-        ON task_history(user_id, timestamp, task_topic) 
-        WHERE correct = 0
+        CREATE TABLE IF NOT EXISTS weekly_top_users (
+            rank INTEGER PRIMARY KEY,
+            user_id INTEGER UNIQUE,
+            username TEXT,
+            total_tasks INTEGER DEFAULT 0,
+            correct_answers INTEGER DEFAULT 0,
+            current_level INTEGER DEFAULT 1,
+            active_days INTEGER DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS materialized_views (
+            view_name TEXT PRIMARY KEY,
+            last_refresh TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            data TEXT
+        )
     ''')
 
+    # Текущее задание пользователя: переживает перезапуск и общее для всех воркеров.
+    # Пока answered_at пуст, бот ждет ответ на это задание
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_difficulty 
-        ON task_history(user_id, difficulty) 
-        WHERE difficulty BETWEEN 3 AND 5
+        CREATE TABLE IF NOT EXISTS current_tasks (
+            user_id INTEGER PRIMARY KEY,
+            task_id TEXT NOT NULL,
+            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            answered_at TIMESTAMP
+        ) WITHOUT ROWID
     ''')
+    ensure_column(cursor, 'current_tasks', 'answered_at', 'TIMESTAMP')
+
+    # До какого места выгружена каждая таблица (export_data.py);
+    # overlap_rows - хеши уже выгруженных строк у границы водяного знака
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_task_history_time_spent 
-        ON task_history(time_spent) 
-        WHERE time_spent IS NOT NULL
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            table_name TEXT PRIMARY KEY,
+            last_value TEXT,
+            exported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            overlap_rows TEXT
+        )
     ''')
+    ensure_column(cursor, 'export_watermarks', 'overlap_rows', 'TEXT')
+
+    create_migration_tables(cursor)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_history_user_time 
+        ON task_history(user_id, timestamp DESC)
+    ''')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_history_user_day 
+        ON task_history(user_id, day, correct)
+    ''')
+
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_users_last_activity 
         ON users(last_activity DESC)
@@ -124,14 +408,23 @@ def init_database():
         CREATE VIEW v_daily_stats AS
         SELECT 
             user_id,
-            DATE(timestamp) as day,
-            COUNT(*) as tasks_per_day,
-            SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct_per_day,
-            AVG(CASE WHEN correct THEN 1.0 ELSE 0.0 END) as daily_accuracy,
-            AVG(time_spent) as avg_time_spent
-        FROM task_history
-        WHERE timestamp IS NOT NULL
-        GROUP BY user_id, DATE(timestamp)
+            day,
+            SUM(attempts) as tasks_per_day,
+            SUM(correct) as correct_per_day,
+            1.0 * SUM(correct) / SUM(attempts) as daily_accuracy,
+            1.0 * SUM(time_spent_sum) / NULLIF(SUM(time_spent_count), 0) as avg_time_spent
+        FROM (
+            SELECT user_id, day, COUNT(*) as attempts,
+                   SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct,
+                   SUM(time_spent) as time_spent_sum, COUNT(time_spent) as time_spent_count
+            FROM task_history
+            WHERE day IS NOT NULL
+            GROUP BY user_id, day
+            UNION ALL
+            SELECT user_id, day, attempts, correct, time_spent_sum, time_spent_count
+            FROM task_history_rollup
+        )
+        GROUP BY user_id, day
         ORDER BY day DESC;
     ''')
 
@@ -140,346 +433,1354 @@ def init_database():
         CREATE VIEW v_user_topics AS
         SELECT 
             user_id,
-            task_topic as topic,
-            COUNT(*) as total_tasks,
-            SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct_tasks,
-            AVG(CASE WHEN correct THEN 1.0 ELSE 0.0 END) as success_rate,
-            MIN(timestamp) as first_solved,
-            MAX(timestamp) as last_solved
-        FROM task_history
-        WHERE task_topic IS NOT NULL
-        GROUP BY user_id, task_topic;
+            topic,
+            SUM(attempts) as total_tasks,
+            SUM(correct) as correct_tasks,
+            1.0 * SUM(correct) / SUM(attempts) as success_rate,
+            MIN(first_seen) as first_solved,
+            MAX(last_seen) as last_solved
+        FROM (
+            SELECT user_id, task_topic as topic, COUNT(*) as attempts,
+                   SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct,
+                   MIN(timestamp) as first_seen, MAX(timestamp) as last_seen
+            FROM task_history
+            WHERE task_topic IS NOT NULL
+            GROUP BY user_id, task_topic
+            UNION ALL
+            SELECT user_id, topic, attempts, correct, first_seen, last_seen
+            FROM task_history_rollup
+            WHERE topic != ''
+        )
+        GROUP BY user_id, topic;
     ''')
 
-    conn.commit()
-    conn.close()
-    create_triggers()
+
+def ensure_column(cursor, table, column, definition):
+    # В старых базах колонки может не быть; CREATE TABLE IF NOT EXISTS ее не добавит
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
-def create_triggers():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DROP TRIGGER IF EXISTS update_user_level_after_insert")
-    cursor.execute("DROP TRIGGER IF EXISTS update_topic_progress_after_insert")
-    cursor.execute("DROP TRIGGER IF EXISTS update_user_activity")
+def drop_legacy_triggers(db_name=None):
+    # Уровень, прогресс по темам и last_activity теперь считает write_answer_batch;
+    # старые триггеры на task_history удаляются, чтобы не дублировать запись
+    with transaction(db_name) as cursor:
+        cursor.execute("DROP TRIGGER IF EXISTS update_user_level_after_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS update_topic_progress_after_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS update_user_activity")
+
+
+def refresh_materialized_views(analytics=True):
+    try:
+        # Чтение идет до начала транзакции, запись результатов занимает
+        # блокировку ненадолго. После пересчета (analytics=False) нужны
+        # рабочие базы: снимок еще не содержит пересчитанных данных
+        sources = {
+            view_name: collect(analytics=analytics)
+            for view_name, collect in MATERIALIZED_VIEW_SOURCES.items()
+        }
+        with transaction() as cursor:
+            for view_name, build_view in MATERIALIZED_VIEW_BUILDERS.items():
+                build_view(cursor, sources[view_name])
+    except Exception as e:
+        print(f"Ошибка обновления материализованных представлений: {e}")
+        return
+
+    print("Материализованные представления обновлены")
+
+
+def refresh_view(view_name):
+    rows = MATERIALIZED_VIEW_SOURCES[view_name](analytics=True)
+    with transaction() as cursor:
+        MATERIALIZED_VIEW_BUILDERS[view_name](cursor, rows)
+
+
+def mark_view_refreshed(cursor, view_name):
     cursor.execute('''
-        CREATE TRIGGER update_user_level_after_insert
-        AFTER INSERT ON task_history
-        FOR EACH ROW
-        BEGIN
-            UPDATE users 
-            SET current_level = (
-                SELECT 
-                    CASE 
-                        WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.85 THEN 5
-                        WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.75 THEN 4
-                        WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.60 THEN 3
-                        WHEN CAST(correct_answers AS REAL) / NULLIF(total_tasks, 0) >= 0.40 THEN 2
-                        ELSE 1
-                    END
-                FROM users 
-                WHERE user_id = NEW.user_id
-            )
-            WHERE user_id = NEW.user_id 
-            AND (
-                -- Обновляем уровень каждые 5 заданий
-                (SELECT total_tasks FROM users WHERE user_id = NEW.user_id) % 5 = 0
-                OR 
-                -- Или если пользователь не был активен последний час
-                (SELECT COUNT(*) FROM task_history 
-                 WHERE user_id = NEW.user_id 
-                 AND timestamp > datetime('now', '-1 hour')) = 0
-            );
-        END;
-    ''')
+        INSERT OR REPLACE INTO materialized_views (view_name, data, last_refresh)
+        VALUES (?, NULL, CURRENT_TIMESTAMP)
+    ''', (view_name,))
+
 
+def collect_top_users_weekly(analytics=False):
+    rows = query_shards('''
+        SELECT 
+            u.user_id,
+            u.username,
+            u.total_tasks,
+            u.correct_answers,
+            u.current_level,
+            COUNT(d.day) as active_days
+        FROM users u
+        JOIN daily_user_stats d ON u.user_id = d.user_id
+        WHERE d.day >= date('now', '-7 days')
+        GROUP BY u.user_id
+        ORDER BY u.total_tasks DESC, u.user_id
+        LIMIT 50
+    ''', analytics=analytics)
+    rows.sort(key=lambda row: (-row[2], row[0]))
+    return rows[:50]
+
+
+def build_top_users_weekly(cursor, rows):
+    cursor.execute("DELETE FROM weekly_top_users")
+    cursor.executemany('''
+        INSERT INTO weekly_top_users
+            (rank, user_id, username, total_tasks, correct_answers, current_level, active_days)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(rank, *row) for rank, row in enumerate(rows, 1)])
+    mark_view_refreshed(cursor, 'top_users_weekly')
+
+
+GLOBAL_TOPIC_STATS_SQL = '''
+    SELECT topic, SUM(total_attempts), SUM(correct_attempts), SUM(difficulty_sum)
+    FROM daily_topic_stats
+    WHERE day >= date('now', '-90 days')
+    GROUP BY topic
+'''
+
+
+def collect_global_topic_stats(analytics=False):
+    # daily_topic_stats ведется в каждом шарде; суммы по темам складываются здесь
+    totals = {}
+    for topic, attempts, correct, difficulty_sum in query_shards(GLOBAL_TOPIC_STATS_SQL, analytics=analytics):
+        total = totals.setdefault(topic, [0, 0, 0])
+        total[0] += attempts
+        total[1] += correct
+        total[2] += difficulty_sum
+    return [
+        (topic, attempts, correct, correct / attempts, difficulty_sum / attempts)
+        for topic, (attempts, correct, difficulty_sum) in totals.items()
+        if attempts
+    ]
+
+
+def build_global_topic_stats(cursor, rows):
+    cursor.execute("DELETE FROM topic_global_stats")
+    cursor.executemany('''
+        INSERT INTO topic_global_stats
+            (topic, total_attempts, correct_attempts, global_success_rate, avg_difficulty)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    mark_view_refreshed(cursor, 'global_topic_stats')
+
+
+MATERIALIZED_VIEW_SOURCES = {
+    'top_users_weekly': collect_top_users_weekly,
+    'global_topic_stats': collect_global_topic_stats,
+}
+
+MATERIALIZED_VIEW_BUILDERS = {
+    'top_users_weekly': build_top_users_weekly,
+    'global_topic_stats': build_global_topic_stats,
+}
+
+
+def read_user_stats_daily():
+    # Строки собираются из аналитических снимков всех шардов
+    rows = query_shards('''
+        SELECT user_id, day, tasks_per_day, correct_per_day,
+               CAST(correct_per_day AS REAL) / tasks_per_day as daily_accuracy
+        FROM daily_user_stats
+        WHERE day >= date('now', '-30 days')
+    ''', analytics=True)
+    return [
+        {
+            'user_id': row[0],
+            'day': row[1],
+            'tasks_per_day': row[2],
+            'correct_per_day': row[3],
+            'daily_accuracy': row[4]
+        }
+        for row in rows
+    ]
+
+
+def read_top_users_weekly(cursor, limit=50):
     cursor.execute('''
-        CREATE TRIGGER update_topic_progress_after_insert
-        AFTER INSERT ON task_history
-        FOR EACH ROW
-        BEGIN
-            INSERT OR REPLACE INTO topic_progress (user_id, topic, tasks_solved, correct_rate, last_solved)
-            VALUES (
-                NEW.user_id,
-                NEW.task_topic,
-                COALESCE((SELECT tasks_solved + 1 FROM topic_progress 
-                         WHERE user_id = NEW.user_id AND topic = NEW.task_topic), 1),
-                COALESCE((SELECT (correct_rate * tasks_solved + CASE WHEN NEW.correct THEN 1.0 ELSE 0.0 END) / (tasks_solved + 1)
-                         FROM topic_progress 
-                         WHERE user_id = NEW.user_id AND topic = NEW.task_topic),
-                         CASE WHEN NEW.correct THEN 1.0 ELSE 0.0 END),
-                NEW.timestamp
-            );
-        END;
-    ''')
+        SELECT user_id, username, total_tasks, correct_answers, current_level, active_days
+        FROM weekly_top_users
+        ORDER BY rank
+        LIMIT ?
+    ''', (limit,))
+    return [
+        {
+            'user_id': row[0],
+            'username': row[1],
+            'total_tasks': row[2],
+            'correct_answers': row[3],
+            'current_level': row[4],
+            'active_days': row[5]
+        }
+        for row in cursor.fetchall()
+    ]
+
 
+def read_global_topic_stats(cursor):
     cursor.execute('''
-        CREATE TRIGGER update_user_activity
-        AFTER INSERT ON task_history
-        FOR EACH ROW
-        BEGIN
-            UPDATE users 
-            SET last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = NEW.user_id;
-        END;
+        SELECT topic, total_attempts, correct_attempts, global_success_rate, avg_difficulty
+        FROM topic_global_stats
     ''')
+    return [
+        {
+            'topic': row[0],
+            'total_attempts': row[1],
+            'correct_attempts': row[2],
+            'global_success_rate': row[3],
+            'avg_difficulty': row[4]
+        }
+        for row in cursor.fetchall()
+    ]
+
 
-    conn.commit()
-    conn.close()
+MATERIALIZED_VIEW_READERS = {
+    'top_users_weekly': read_top_users_weekly,
+    'global_topic_stats': read_global_topic_stats,
+}
 
-def refresh_materialized_views(cursor=None):
-    close_conn = False
-    if cursor is None:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        close_conn = True
 
+def get_user_daily_stats(user_id, days=30):
+    cursor = get_connection(shard_db_name(user_id)).cursor()
+    cursor.execute('''
+        SELECT day, tasks_per_day, correct_per_day
+        FROM daily_user_stats
+        WHERE user_id = ? AND day >= date('now', ?)
+        ORDER BY day DESC
+    ''', (user_id, f'-{days} days'))
+    return [
+        {
+            'day': day,
+            'tasks_per_day': tasks_per_day,
+            'correct_per_day': correct_per_day,
+            'daily_accuracy': correct_per_day / tasks_per_day if tasks_per_day else 0
+        }
+        for day, tasks_per_day, correct_per_day in cursor.fetchall()
+    ]
+
+
+def get_top_users(limit=10):
+    return read_top_users_weekly(get_connection().cursor(), limit)
+
+
+def get_topic_global_stats(topic):
+    cursor = get_connection().cursor()
+    cursor.execute('''
+        SELECT total_attempts, correct_attempts, global_success_rate, avg_difficulty
+        FROM topic_global_stats WHERE topic = ?
+    ''', (topic,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {
+        'topic': topic,
+        'total_attempts': row[0],
+        'correct_attempts': row[1],
+        'global_success_rate': row[2],
+        'avg_difficulty': row[3]
+    }
+
+
+# Дневные агрегаты шарда по task_history и свертке архива
+DAILY_USER_STATS_REBUILD_SQL = '''
+    SELECT user_id, day, SUM(attempts) AS attempts, SUM(correct) AS correct
+    FROM (
+        SELECT user_id, day, COUNT(*) AS attempts,
+               SUM(CASE WHEN correct THEN 1 ELSE 0 END) AS correct
+        FROM task_history
+        WHERE day IS NOT NULL AND id <= ?
+        GROUP BY user_id, day
+        UNION ALL
+        SELECT user_id, day, attempts, correct FROM task_history_rollup
+    )
+    GROUP BY user_id, day
+'''
+
+DAILY_TOPIC_STATS_REBUILD_SQL = '''
+    SELECT topic, day, SUM(attempts) AS attempts, SUM(correct) AS correct,
+           SUM(difficulty_sum) AS difficulty_sum
+    FROM (
+        SELECT task_topic AS topic, day, COUNT(*) AS attempts,
+               SUM(CASE WHEN correct THEN 1 ELSE 0 END) AS correct,
+               COALESCE(SUM(difficulty), 0) AS difficulty_sum
+        FROM task_history
+        WHERE day IS NOT NULL AND task_topic IS NOT NULL AND id <= ?
+        GROUP BY task_topic, day
+        UNION ALL
+        SELECT topic, day, attempts, correct, difficulty_sum
+        FROM task_history_rollup
+        WHERE topic != ''
+    )
+    GROUP BY topic, day
+'''
+
+
+def rebuild_materialized_views():
+    # Полный пересчет дневных агрегатов; только для периодической задачи.
+    # Шарды пересчитываются по очереди, затем представления основной базы
+    # строятся по их суммам
     try:
-        cursor.execute('''
-            SELECT 
-                user_id,
-                DATE(timestamp) as day,
-                COUNT(*) as tasks_per_day,
-                SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct_per_day,
-                AVG(CASE WHEN correct THEN 1.0 ELSE 0.0 END) as daily_accuracy
-            FROM task_history
-            WHERE timestamp >= date('now', '-30 days')
-            GROUP BY user_id, DATE(timestamp)
-        ''')
+        for db_name in shard_names():
+            swap_shard_aggregates(db_name, stage_shard_aggregates(db_name))
+
+        if DB_NAME not in shard_names():
+            with transaction() as cursor:
+                # Темы раньше суммировались в основной базе; теперь их ведут шарды
+                cursor.execute("DELETE FROM daily_topic_stats")
+        refresh_materialized_views(analytics=False)
+    except Exception as e:
+        print(f"Ошибка пересчета материализованных представлений: {e}")
 
-        daily_stats = []
-        for row in cursor.fetchall():
-            daily_stats.append({
-                'user_id': row[0],
-                'day': row[1],
-                'tasks_per_day': row[2],
-                'correct_per_day': row[3],
-                'daily_accuracy': row[4]
-            })
 
+def stage_shard_aggregates(db_name):
+    # GROUP BY по всей истории идет во временные таблицы в читающей транзакции:
+    # в режиме WAL она не мешает записи ответов. Возвращает последний учтенный id
+    conn = get_connection(db_name)
+    conn.execute("BEGIN")
+    try:
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM task_history").fetchone()[0]
+        conn.execute("DROP TABLE IF EXISTS temp.rebuilt_daily_user_stats")
+        conn.execute("DROP TABLE IF EXISTS temp.rebuilt_daily_topic_stats")
+        conn.execute(
+            f"CREATE TEMP TABLE rebuilt_daily_user_stats AS {DAILY_USER_STATS_REBUILD_SQL}", (last_id,)
+        )
+        conn.execute(
+            f"CREATE TEMP TABLE rebuilt_daily_topic_stats AS {DAILY_TOPIC_STATS_REBUILD_SQL}", (last_id,)
+        )
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return last_id
+
+
+def swap_shard_aggregates(db_name, last_id):
+    # Под блокировкой записи только подмена строк и досчет ответов,
+    # записанных после снимка (id > last_id)
+    with transaction(db_name) as cursor:
+        cursor.execute("DELETE FROM daily_user_stats")
         cursor.execute('''
-            INSERT OR REPLACE INTO materialized_views (view_name, data, last_refresh)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', ('user_stats_daily', json.dumps(daily_stats)))
-
+            INSERT INTO daily_user_stats (user_id, day, tasks_per_day, correct_per_day)
+            SELECT user_id, day, SUM(attempts), SUM(correct)
+            FROM (
+                SELECT user_id, day, attempts, correct FROM temp.rebuilt_daily_user_stats
+                UNION ALL
+                SELECT user_id, day, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END)
+                FROM task_history
+                WHERE id > ? AND day IS NOT NULL
+                GROUP BY user_id, day
+            )
+            GROUP BY user_id, day
+        ''', (last_id,))
+        cursor.execute("DELETE FROM daily_topic_stats")
         cursor.execute('''
-            SELECT 
-                u.user_id,
-                u.username,
-                u.total_tasks,
-                u.correct_answers,
-                u.current_level,
-                COUNT(DISTINCT DATE(th.timestamp)) as active_days
-            FROM users u
-            LEFT JOIN task_history th ON u.user_id = th.user_id
-            WHERE th.timestamp >= date('now', '-7 days')
-            GROUP BY u.user_id
-            ORDER BY total_tasks DESC
-            LIMIT 50
+            INSERT INTO daily_topic_stats (topic, day, total_attempts, correct_attempts, difficulty_sum)
+            SELECT topic, day, SUM(attempts), SUM(correct), SUM(difficulty_sum)
+            FROM (
+                SELECT topic, day, attempts, correct, difficulty_sum FROM temp.rebuilt_daily_topic_stats
+                UNION ALL
+                SELECT task_topic, day, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END),
+                       COALESCE(SUM(difficulty), 0)
+                FROM task_history
+                WHERE id > ? AND day IS NOT NULL AND task_topic IS NOT NULL
+                GROUP BY task_topic, day
+            )
+            GROUP BY topic, day
+        ''', (last_id,))
+    conn = get_connection(db_name)
+    conn.execute("DROP TABLE temp.rebuilt_daily_user_stats")
+    conn.execute("DROP TABLE temp.rebuilt_daily_topic_stats")
+
+ARCHIVE_HORIZON_DAYS = 180
+ARCHIVE_BATCH_SIZE = 5000
+# Сколько свободных страниц возвращается системе за один проход архивации;
+# остаток освобождается в следующие ночи
+ARCHIVE_VACUUM_PAGES = 10000
+
+
+def archive_db_name(db_name=None):
+    base, ext = os.path.splitext(db_name or DB_NAME)
+    return f"{base}_archive{ext or '.db'}"
+
+
+def archive_task_history(horizon_days=ARCHIVE_HORIZON_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    archived = sum(archive_shard(db_name, horizon_days, batch_size) for db_name in shard_names())
+    if archived:
+        print(f"Заархивировано строк task_history: {archived}")
+    return archived
+
+
+def archive_shard(db_name, horizon_days, batch_size):
+    # Строки старше горизонта сворачиваются в task_history_rollup и переносятся
+    # в файл архива шарда; переносятся целые дни, чтобы дневная статистика не делилась
+    batch_ids = '''
+        SELECT id FROM main.task_history
+        WHERE day < date('now', ?)
+        ORDER BY id LIMIT ?
+    '''
+    batch_args = (f"-{int(horizon_days)} days", batch_size)
+
+    archived = 0
+    # ATTACH невозможен внутри транзакции, поэтому у архивации свое соединение
+    conn = open_connection(db_name)
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_db_name(db_name),))
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.task_history (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                task_id TEXT,
+                task_topic TEXT,
+                correct BOOLEAN,
+                difficulty INTEGER,
+                time_spent INTEGER DEFAULT NULL,
+                timestamp TIMESTAMP,
+                day TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_history_user_time
+            ON task_history(user_id, timestamp DESC)
         ''')
 
-        top_users = []
-        for row in cursor.fetchall():
-            top_users.append({
-                'user_id': row[0],
-                'username': row[1],
-                'total_tasks': row[2],
-                'correct_answers': row[3],
-                'current_level': row[4],
-                'active_days': row[5]
-            })
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(f'''
+                    INSERT INTO main.task_history_rollup (
+                        user_id, day, topic, attempts, correct, difficulty_sum,
+                        time_spent_sum, time_spent_count, first_seen, last_seen
+                    )
+                    SELECT user_id, day, COALESCE(task_topic, ''), COUNT(*),
+                           SUM(CASE WHEN correct THEN 1 ELSE 0 END), COALESCE(SUM(difficulty), 0),
+                           COALESCE(SUM(time_spent), 0), COUNT(time_spent),
+                           MIN(timestamp), MAX(timestamp)
+                    FROM main.task_history
+                    WHERE id IN ({batch_ids})
+                    GROUP BY user_id, day, COALESCE(task_topic, '')
+                    ON CONFLICT(user_id, day, topic) DO UPDATE SET
+                        attempts = attempts + excluded.attempts,
+                        correct = correct + excluded.correct,
+                        difficulty_sum = difficulty_sum + excluded.difficulty_sum,
+                        time_spent_sum = time_spent_sum + excluded.time_spent_sum,
+                        time_spent_count = time_spent_count + excluded.time_spent_count,
+                        first_seen = MIN(first_seen, excluded.first_seen),
+                        last_seen = MAX(last_seen, excluded.last_seen)
+                ''', batch_args)
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO archive.task_history
+                        (id, user_id, task_id, task_topic, correct, difficulty, time_spent, timestamp, day)
+                    SELECT id, user_id, task_id, task_topic, correct, difficulty, time_spent, timestamp, day
+                    FROM main.task_history
+                    WHERE id IN ({batch_ids})
+                ''', batch_args)
+                moved = conn.execute(
+                    f"DELETE FROM main.task_history WHERE id IN ({batch_ids})", batch_args
+                ).rowcount
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            archived += moved
+            if moved < batch_size:
+                break
 
-        cursor.execute('''
-            INSERT OR REPLACE INTO materialized_views (view_name, data, last_refresh)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', ('top_users_weekly', json.dumps(top_users)))
+        conn.execute("DETACH DATABASE archive")
+        if archived and not reclaim_free_pages(conn):
+            print(f"{db_name} создана без auto_vacuum=INCREMENTAL: место не освобождается, "
+                  f"запустите compact_databases.py при остановленном боте")
+    except Exception as e:
+        print(f"Ошибка архивации task_history в {db_name}: {e}")
+    finally:
+        conn.close()
+    return archived
 
-        cursor.execute('''
-            SELECT 
-                task_topic,
-                COUNT(*) as total_attempts,
-                SUM(CASE WHEN correct THEN 1 ELSE 0 END) as correct_attempts,
-                AVG(CASE WHEN correct THEN 1.0 ELSE 0.0 END) as global_success_rate,
-                AVG(difficulty) as avg_difficulty
-            FROM task_history
-            WHERE timestamp >= date('now', '-90 days')
-            GROUP BY task_topic
-        ''')
 
-        topic_stats = []
-        for row in cursor.fetchall():
-            topic_stats.append({
-                'topic': row[0],
-                'total_attempts': row[1],
-                'correct_attempts': row[2],
-                'global_success_rate': row[3],
-                'avg_difficulty': row[4]
-            })
+def reclaim_free_pages(conn, pages=ARCHIVE_VACUUM_PAGES):
+    # Полный VACUUM держит базу заблокированной на все время перезаписи файла,
+    # поэтому рабочий бот его не запускает: старые базы переводятся в режим
+    # INCREMENTAL отдельно (compact_databases.py)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return False
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return True
 
-        cursor.execute('''
-            INSERT OR REPLACE INTO materialized_views (view_name, data, last_refresh)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', ('global_topic_stats', json.dumps(topic_stats)))
 
-        if close_conn:
-            conn.commit()
-            conn.close()
+def read_archived_results(user_id, limit):
+    path = archive_db_name(shard_db_name(user_id))
+    if limit <= 0 or not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return [row[0] for row in conn.execute('''
+            SELECT correct FROM task_history
+            WHERE user_id = ?
+            ORDER BY timestamp DESC, id DESC LIMIT ?
+        ''', (user_id, limit))]
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
 
-        print("Материализованные представления обновлены")
 
-    except Exception as e:
-        print(f"Ошибка обновления материализованных ghtlcnfdktybq: {e}")
-        if close_conn:
-            conn.rollback()
-            conn.close()
+MATERIALIZED_VIEW_TTL = 3600
+VIEW_REFRESH_BACKOFF_BASE = 5
+VIEW_REFRESH_BACKOFF_MAX = 600
 
 
-def get_materialized_view(view_name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def read_materialized_view(view_name):
+    if view_name == 'user_stats_daily':
+        # Дневная статистика поддерживается дельтами и всегда актуальна
+        return read_user_stats_daily(), None
 
+    cursor = get_connection().cursor()
+    read_view = MATERIALIZED_VIEW_READERS[view_name]
     cursor.execute('''
-        SELECT data, last_refresh 
+        SELECT last_refresh 
         FROM materialized_views 
         WHERE view_name = ?
     ''', (view_name,))
-
     row = cursor.fetchone()
-    conn.close()
+    if row is None:
+        return None
+    return read_view(cursor), row[0]
 
-    if row:
-        data_json, last_refresh = row
-        refresh_time = datetime.fromisoformat(last_refresh)
-        if (datetime.now() - refresh_time).seconds > 3600:
-            threading.Thread(target=refresh_materialized_views, daemon=True).start()
 
-        return json.loads(data_json)
-    else:
-        refresh_materialized_views()
-        return get_materialized_view(view_name)  # Рекурсивный вызов
+def is_view_stale(last_refresh, ttl=MATERIALIZED_VIEW_TTL):
+    if last_refresh is None:
+        return False
+    # last_refresh пишется через CURRENT_TIMESTAMP, то есть в UTC
+    refresh_time = datetime.fromisoformat(last_refresh)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (now - refresh_time).total_seconds() > ttl
 
 
-def update_user_stats(user_id, task_id, is_correct, time_spent=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    tasks = load_tasks()
-    task = next((t for t in tasks if t['id'] == task_id), None)
+def get_materialized_view(view_name):
+    row = read_materialized_view(view_name)
+    if row is None:
+        # Отсутствующее представление тоже строится через координатор:
+        # одновременные читатели ждут одного обновления
+        view_refresher.refresh_blocking(view_name)
+        row = read_materialized_view(view_name)
+        return row[0] if row else []
+
+    data, last_refresh = row
+    if is_view_stale(last_refresh, view_refresher.ttl):
+        view_refresher.request_refresh_threadsafe(view_name)
+    return data
+
+
+class ViewRefreshCoordinator:
+    # Не больше одного обновления на представление; пока оно идет,
+    # читатели получают прежние (устаревшие) данные
+    def __init__(self, ttl=MATERIALIZED_VIEW_TTL, backoff_base=VIEW_REFRESH_BACKOFF_BASE,
+                 backoff_max=VIEW_REFRESH_BACKOFF_MAX):
+        self.ttl = ttl
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._inflight = {}
+        self._failures = {}
+        self._retry_at = {}
+        self._loop = None
+        self._blocking_lock = threading.Lock()
+        # Обновления идут в собственном потоке, а не в пуле db: рабочий поток db,
+        # ждущий обновления в refresh_blocking, не занимает поток, нужный самому обновлению
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="view-refresh")
+        self._rebuild_task = None
+
+    def bind(self, loop):
+        # Цикл событий, в котором идут обновления; синхронные читатели
+        # из рабочих потоков передают ему запросы
+        self._loop = loop
+
+    async def get(self, view_name):
+        self._loop = asyncio.get_running_loop()
+        row = await db.run(read_materialized_view, view_name)
+        if row is None:
+            await self.refresh(view_name)
+            row = await db.run(read_materialized_view, view_name)
+            return row[0] if row else []
+
+        data, last_refresh = row
+        if is_view_stale(last_refresh, self.ttl):
+            self.request_refresh(view_name)
+        return data
+
+    async def refresh(self, view_name):
+        task = self.request_refresh(view_name)
+        if task is not None:
+            await asyncio.shield(task)
+
+    def request_refresh(self, view_name):
+        task = self._inflight.get(view_name)
+        if task is not None:
+            return task
+        if time.monotonic() < self._retry_at.get(view_name, 0):
+            return None
+
+        self._loop = asyncio.get_running_loop()
+        task = asyncio.create_task(self._run(view_name))
+        self._inflight[view_name] = task
+        return task
+
+    def request_refresh_threadsafe(self, view_name):
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(self.request_refresh, view_name)
+
+    def refresh_blocking(self, view_name):
+        loop = self._loop
+        if loop is not None and loop.is_running() and not self._in_loop_thread(loop):
+            asyncio.run_coroutine_threadsafe(self.refresh(view_name), loop).result()
+            return
+        # Без цикла событий (скрипты, тесты) обновления идут по одному,
+        # а дождавшийся очереди не строит представление повторно
+        with self._blocking_lock:
+            if read_materialized_view(view_name) is None:
+                refresh_view(view_name)
+
+    @staticmethod
+    def _in_loop_thread(loop):
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    async def rebuild(self):
+        # Плановый полный пересчет идет в том же потоке, что и обновления
+        # представлений: они не пересекаются и не ждут друг друга за блокировкой записи
+        task = self._rebuild_task
+        if task is None:
+            task = asyncio.create_task(self._run_rebuild())
+            self._rebuild_task = task
+        await asyncio.shield(task)
+
+    async def _run_rebuild(self):
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, rebuild_materialized_views)
+        finally:
+            self._rebuild_task = None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, view_name):
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, refresh_view, view_name)
+            self._failures.pop(view_name, None)
+            self._retry_at.pop(view_name, None)
+        except Exception as e:
+            failures = self._failures.get(view_name, 0) + 1
+            self._failures[view_name] = failures
+            delay = min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+            self._retry_at[view_name] = time.monotonic() + delay
+            print(f"Ошибка обновления представления {view_name}: {e}, повтор через {delay} сек")
+        finally:
+            self._inflight.pop(view_name, None)
+
+
+view_refresher = ViewRefreshCoordinator()
+
+
+def submit_answer(user_id, task_id, answer, time_spent=None):
+    # Проверка ответа, запись и переход уровня за одну транзакцию:
+    # уровень до ответа читается внутри нее же, отдельного get_user_stats нет
+    task = task_catalog.get(task_id)
     if not task:
-        print(f"Задание {task_id} не найдено в базе")
-        conn.close()
         return None
-    task_topic = task['topic']
-    difficulty = task.get('difficulty', 1)
-    try:
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, current_level) 
-            VALUES (?, 1)
-        ''', (user_id,))
-        cursor.execute('''
-            INSERT INTO task_history 
-            (user_id, task_id, task_topic, correct, difficulty, time_spent)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, task_id, task_topic, is_correct, difficulty, time_spent))
-        if is_correct:
-            cursor.execute('''
-                UPDATE users 
-                SET total_tasks = total_tasks + 1,
-                    correct_answers = correct_answers + 1
-                WHERE user_id = ?
-            ''', (user_id,))
-        else:
-            cursor.execute('''
-                UPDATE users 
-                SET total_tasks = total_tasks + 1
-                WHERE user_id = ?
-            ''', (user_id,))
+    is_correct = check_answer(answer, task['correct_answer'])
+    result = write_answer_events([(user_id, task_id, is_correct, time_spent)])[0]
+    return make_answer_result(task, is_correct, result)
 
-        conn.commit()
 
-    except Exception as e:
-        print(f"Ошибка обновления статистики: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+def make_answer_result(task, is_correct, result):
+    if result is None:
+        return None
+    old_level, stats = result
+    return {
+        "is_correct": is_correct,
+        "correct_answer": task['correct_answer'],
+        "old_level": old_level,
+        "new_level": stats["current_level"],
+        "level_up": stats["current_level"] > old_level,
+        "stats": stats,
+    }
+
+
+def update_user_stats(user_id, task_id, is_correct, time_spent=None):
     try:
-        refresh_materialized_views()
+        results = write_answer_batch([(user_id, task_id, is_correct, time_spent)])
     except Exception as e:
-        print(f"Ошибка обновления представлений: {e}")
-    return get_user_stats(user_id)
+        print(f"Ошибка обновления статистики: {e}")
+        return get_user_stats(user_id)
+    return results[0]
+
+
+def write_answer_batch(events):
+    return [result[1] if result else None for result in write_answer_events(events)]
+
+
+def write_answer_events(events):
+    # Для каждого события - (уровень до ответа, статистика после него) или None
+    rows = []
+    for user_id, task_id, is_correct, time_spent in events:
+        task = task_catalog.get(task_id)
+        if not task:
+            print(f"Задание {task_id} не найдено в базе")
+            continue
+        rows.append((user_id, task_id, task['topic'], bool(is_correct), task_difficulty(task), time_spent))
+
+    if not rows:
+        return [None] * len(events)
+
+    shard_rows = {}
+    for row in rows:
+        shard_rows.setdefault(shard_db_name(row[0]), []).append(row)
+
+    results = {}
+    for db_name, batch in shard_rows.items():
+        # Все изменения ответа, включая дневные суммы по темам, остаются в его шарде:
+        # запись в разные шарды не делит ни одной блокировки
+        try:
+            with transaction(db_name) as cursor:
+                shard_results, topics = write_user_answers(cursor, batch)
+                write_topic_deltas(cursor, batch)
+        except BaseException:
+            user_profile_cache.invalidate({row[0] for row in batch})
+            raise
+        results.update(shard_results)
+        update_profile_cache(batch, shard_results, topics)
+
+    # Результат каждого события - состояние пользователя сразу после этого ответа
+    output = []
+    for user_id, task_id, _, _ in events:
+        if task_catalog.get(task_id) and results.get(user_id):
+            output.append(results[user_id].pop(0))
+        else:
+            output.append(None)
+    return output
+
+
+def write_user_answers(cursor, rows):
+    user_ids = list(dict.fromkeys(row[0] for row in rows))
+    users = {}
+    topics = {}
+    for user_id, total_tasks, correct_answers, current_level, last_activity in select_by_user_ids(cursor, '''
+        SELECT user_id, total_tasks, correct_answers, current_level, last_activity
+        FROM users WHERE user_id IN ({placeholders})
+    ''', user_ids):
+        users[user_id] = [total_tasks, correct_answers, current_level, is_inactive(last_activity)]
+    for user_id, topic, tasks_solved, correct_rate in select_by_user_ids(cursor, '''
+        SELECT user_id, topic, tasks_solved, correct_rate
+        FROM topic_progress WHERE user_id IN ({placeholders})
+    ''', user_ids):
+        topics[(user_id, topic)] = [tasks_solved, correct_rate]
+
+    # Уровень и прогресс по темам считаются по уже известным значениям,
+    # каждая строка users и topic_progress записывается один раз
+    results = {}
+    daily_deltas = {}
+    for user_id, task_id, topic, is_correct, _, _ in rows:
+        user = users.setdefault(user_id, [0, 0, 1, False])
+        old_level = user[2]
+        user[0] += 1
+        user[1] += 1 if is_correct else 0
+        # Уровень пересчитывается по счетчикам после ответа на каждом пятом ответе
+        # (5-й, 10-й, ...) и на первом ответе после часа без активности. Старый
+        # триггер считал по счетчикам до ответа (1-й, 6-й, 11-й ответ), а его ветка
+        # бездействия не срабатывала: COUNT видел только что вставленную строку
+        if user[0] % 5 == 0 or user[3]:
+            user[2] = calculate_level(user[1], user[0])
+            user[3] = False
+
+        progress = topics.setdefault((user_id, topic), [0, 0.0])
+        progress[1] = (progress[1] * progress[0] + (1.0 if is_correct else 0.0)) / (progress[0] + 1)
+        progress[0] += 1
+
+        total, correct = daily_deltas.get(user_id, (0, 0))
+        daily_deltas[user_id] = (total + 1, correct + (1 if is_correct else 0))
+
+        results.setdefault(user_id, []).append((old_level, make_user_stats(user[0], user[1], user[2])))
+
+    cursor.executemany('''
+        INSERT INTO users (user_id, total_tasks, correct_answers, current_level, last_activity, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_tasks = excluded.total_tasks,
+            correct_answers = excluded.correct_answers,
+            current_level = excluded.current_level,
+            last_activity = excluded.last_activity,
+            updated_at = excluded.updated_at
+    ''', [(user_id, *users[user_id][:3]) for user_id in user_ids])
+    cursor.executemany('''
+        INSERT INTO task_history 
+        (user_id, task_id, task_topic, correct, difficulty, time_spent, day)
+        VALUES (?, ?, ?, ?, ?, ?, date('now'))
+    ''', rows)
+    cursor.executemany('''
+        INSERT INTO topic_progress (user_id, topic, tasks_solved, correct_rate, last_solved, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, topic) DO UPDATE SET
+            tasks_solved = excluded.tasks_solved,
+            correct_rate = excluded.correct_rate,
+            last_solved = excluded.last_solved,
+            updated_at = excluded.updated_at
+    ''', list(dict.fromkeys(
+        (user_id, topic, *topics[(user_id, topic)]) for user_id, _, topic, _, _, _ in rows
+    )))
+    cursor.executemany('''
+        INSERT INTO user_task_summary (user_id, task_id, attempts, correct, last_seen)
+        VALUES (?, ?, 1, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, task_id) DO UPDATE SET
+            attempts = attempts + 1,
+            correct = correct + excluded.correct,
+            last_seen = excluded.last_seen
+    ''', [(user_id, task_id, 1 if is_correct else 0) for user_id, task_id, _, is_correct, _, _ in rows])
+    cursor.executemany('''
+        INSERT INTO daily_user_stats (user_id, day, tasks_per_day, correct_per_day)
+        VALUES (?, date('now'), ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            tasks_per_day = tasks_per_day + excluded.tasks_per_day,
+            correct_per_day = correct_per_day + excluded.correct_per_day
+    ''', [(user_id, total, correct) for user_id, (total, correct) in daily_deltas.items()])
+    return results, topics
+
+
+def update_profile_cache(rows, results, topics):
+    answers = {}
+    for user_id, _, _, is_correct, _, _ in rows:
+        answers.setdefault(user_id, []).append(is_correct)
+    user_topics = {}
+    for (user_id, topic), (tasks_solved, correct_rate) in topics.items():
+        user_topics.setdefault(user_id, {})[topic] = (tasks_solved, correct_rate)
+    for user_id, user_results in results.items():
+        user_profile_cache.record_answers(
+            user_id, user_results[-1][1], user_topics.get(user_id, {}), answers[user_id]
+        )
+
+
+def write_topic_deltas(cursor, rows):
+    topic_deltas = {}
+    for _, _, topic, is_correct, difficulty, _ in rows:
+        total, correct, difficulty_sum = topic_deltas.get(topic, (0, 0, 0))
+        topic_deltas[topic] = (total + 1, correct + (1 if is_correct else 0), difficulty_sum + difficulty)
+    cursor.executemany('''
+        INSERT INTO daily_topic_stats (topic, day, total_attempts, correct_attempts, difficulty_sum)
+        VALUES (?, date('now'), ?, ?, ?)
+        ON CONFLICT (topic, day) DO UPDATE SET
+            total_attempts = total_attempts + excluded.total_attempts,
+            correct_attempts = correct_attempts + excluded.correct_attempts,
+            difficulty_sum = difficulty_sum + excluded.difficulty_sum
+    ''', [(topic, *delta) for topic, delta in topic_deltas.items()])
+
+
+def select_by_user_ids(cursor, sql, user_ids):
+    for start in range(0, len(user_ids), BATCH_QUERY_CHUNK):
+        chunk = user_ids[start:start + BATCH_QUERY_CHUNK]
+        cursor.execute(sql.format(placeholders=",".join("?" * len(chunk))), chunk)
+        yield from cursor.fetchall()
+
+
+LEVEL_RECALC_IDLE_SECONDS = 3600
+
+
+def is_inactive(last_activity):
+    if not last_activity:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (now - datetime.fromisoformat(last_activity)).total_seconds() > LEVEL_RECALC_IDLE_SECONDS
+
+
+def calculate_level(correct_answers, total_tasks):
+    if total_tasks <= 0:
+        return 1
+    correct_rate = correct_answers / total_tasks
+    for level in sorted(DIFFICULTY_LEVELS, reverse=True):
+        if correct_rate >= DIFFICULTY_LEVELS[level]["correct_rate_threshold"]:
+            return level
+    return 1
+
+
+def make_user_stats(total_tasks, correct_answers, current_level):
+    correct_rate = correct_answers / total_tasks if total_tasks > 0 else 0
+    return {
+        "total_tasks": total_tasks,
+        "correct_answers": correct_answers,
+        "correct_rate": correct_rate,
+        "current_level": current_level,
+        "level_name": DIFFICULTY_LEVELS.get(current_level, {}).get("name", "Новичок")
+    }
+
+
+ANSWER_FLUSH_INTERVAL = 0.05
+ANSWER_BATCH_SIZE = 200
+
+
+class ShardAnswerWriter:
+    # Ответы одного шарда копятся в очереди и записываются пачкой в одной
+    # транзакции: один fsync на всю пачку вместо одного на каждый ответ
+    def __init__(self, db_name, flush_interval=ANSWER_FLUSH_INTERVAL, batch_size=ANSWER_BATCH_SIZE):
+        self.db_name = db_name
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._user_futures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def submit(self, user_id, task_id, is_correct, time_spent=None, with_old_level=False):
+        # with_old_level: результатом будет (уровень до ответа, статистика) вместо статистики
+        future = Future()
+        future.with_old_level = with_old_level
+        with self._lock:
+            self._pending.append(((user_id, task_id, is_correct, time_spent), future))
+            self._user_futures[user_id] = future
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name=f"answer-writer-{os.path.basename(self.db_name)}", daemon=True
+                )
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+        return future
+
+    def pending_future(self, user_id):
+        with self._lock:
+            return self._user_futures.get(user_id)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            with self._lock:
+                if self._stopping and not self._pending:
+                    self._thread = None
+                    return
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not batch:
+                return
+
+            try:
+                results = write_answer_events([event for event, _ in batch])
+            except Exception as e:
+                print(f"Ошибка записи пачки ответов: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if result is not None and not future.with_old_level:
+                        result = result[1]
+                    future.set_result(result)
+
+            with self._lock:
+                for (event, future) in batch:
+                    if self._user_futures.get(event[0]) is future:
+                        del self._user_futures[event[0]]
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+        if thread is not None:
+            self._wakeup.set()
+            thread.join()
+        self.flush()
+
+
+class AnswerWriter:
+    # У каждого шарда своя очередь и свой поток записи: шарды пишутся
+    # параллельно, а ошибка записи в один шард отклоняет только его ответы
+    def __init__(self, flush_interval=ANSWER_FLUSH_INTERVAL, batch_size=ANSWER_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def _shard_writer(self, db_name, create=True):
+        with self._lock:
+            writer = self._shards.get(db_name)
+            if writer is None and create:
+                writer = ShardAnswerWriter(db_name, self.flush_interval, self.batch_size)
+                self._shards[db_name] = writer
+            return writer
+
+    def submit(self, user_id, task_id, is_correct, time_spent=None, with_old_level=False):
+        writer = self._shard_writer(shard_db_name(user_id))
+        return writer.submit(user_id, task_id, is_correct, time_spent, with_old_level)
+
+    def pending_future(self, user_id):
+        writer = self._shard_writer(shard_db_name(user_id), create=False)
+        return writer.pending_future(user_id) if writer else None
+
+    def flush(self):
+        with self._lock:
+            writers = list(self._shards.values())
+        for writer in writers:
+            writer.flush()
+
+    def stop(self):
+        with self._lock:
+            writers = list(self._shards.values())
+        for writer in writers:
+            writer.stop()
+
+
+answer_writer = AnswerWriter()
+
+
+MIGRATION_CHUNK_SIZE = 10000
+
+
+def parse_version(version):
+    # "1.10.0" -> (1, 10, 0): строки сравнивались бы неверно ("1.10.0" < "1.2.0")
+    return tuple(int(part) for part in version.split("."))
+
+
+class AddColumn:
+    # ALTER TABLE ADD COLUMN, который не падает, если колонка уже есть
+    def __init__(self, table, column, definition):
+        self.table = table
+        self.column = column
+        self.definition = definition
+        self.sql = f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+
+    def apply(self, cursor):
+        ensure_column(cursor, self.table, self.column, self.definition)
+
+
+class CreateIndex:
+    # CREATE INDEX, который не падает, если индекс уже создан create_schema
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        self.sql = f"CREATE INDEX {name} ON {definition}"
+
+    def apply(self, cursor):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.name} ON {self.definition}")
+
+
+class ChunkedBackfill:
+    # UPDATE по диапазонам rowid: каждая порция в своей транзакции, прогресс
+    # пишется в migration_progress, после сбоя работа продолжается с того же места
+    def __init__(self, table, assignments, where="1", chunk_size=None):
+        self.table = table
+        self.assignments = assignments
+        self.where = where
+        self.chunk_size = chunk_size
+        self.sql = f"UPDATE {table} SET {assignments} WHERE {where}"
+
+    def run(self, version, step, progress, db_name=None):
+        chunk_size = self.chunk_size or MIGRATION_CHUNK_SIZE
+        last_id = progress
+        while True:
+            with transaction(db_name) as cursor:
+                cursor.execute(f"SELECT MAX(rowid) FROM {self.table}")
+                max_id = cursor.fetchone()[0] or 0
+                if last_id >= max_id:
+                    return
+                upper = chunk_upper_bound(cursor, self.table, last_id, chunk_size, max_id)
+                cursor.execute(f'''
+                    UPDATE {self.table} SET {self.assignments}
+                    WHERE rowid > ? AND rowid <= ? AND ({self.where})
+                ''', (last_id, upper))
+                save_migration_progress(cursor, version, step, upper)
+            last_id = upper
+
+
+class ChunkedInsert:
+    # INSERT ... SELECT по диапазонам rowid источника, порция за транзакцию;
+    # chunk_sql прибавляет порцию к уже записанному (ON CONFLICT ... DO UPDATE).
+    # sql - тот же шаг одним запросом, по нему считается контрольная сумма.
+    # Верхняя граница rowid фиксируется до начала записи ответов: более новые
+    # строки уже учтены рабочим путем записи
+    def __init__(self, source, sql, chunk_sql, chunk_size=None):
+        self.source = source
+        self.sql = sql
+        self.chunk_sql = chunk_sql
+        self.chunk_size = chunk_size
+
+    def fix_bound(self, cursor, version, step):
+        cursor.execute(
+            'SELECT max_id FROM migration_progress WHERE version = ? AND step = ?', (version, step)
+        )
+        row = cursor.fetchone()
+        if row is not None and row[0] is not None:
+            return row[0]
+        cursor.execute(f"SELECT MAX(rowid) FROM {self.source}")
+        max_id = cursor.fetchone()[0] or 0
+        save_migration_progress(cursor, version, step, max_id=max_id)
+        return max_id
+
+    def run(self, version, step, progress, db_name=None):
+        chunk_size = self.chunk_size or MIGRATION_CHUNK_SIZE
+        while True:
+            with transaction(db_name) as cursor:
+                # Прогресс читается внутри транзакции записи, поэтому порция
+                # не будет прибавлена дважды
+                max_id = self.fix_bound(cursor, version, step)
+                cursor.execute(
+                    'SELECT last_id FROM migration_progress WHERE version = ? AND step = ?', (version, step)
+                )
+                last_id = cursor.fetchone()[0] or 0
+                if last_id >= max_id:
+                    return
+                upper = chunk_upper_bound(cursor, self.source, last_id, chunk_size, max_id)
+                cursor.execute(self.chunk_sql, (last_id, upper))
+                save_migration_progress(cursor, version, step, upper)
+
+
+CHUNKED_STEPS = (ChunkedBackfill, ChunkedInsert)
+
+
+def chunk_upper_bound(cursor, table, last_id, chunk_size, max_id):
+    # Граница порции - rowid chunk_size-й следующей строки, а не last_id + chunk_size:
+    # rowid бывают разреженными (user_id из Telegram, удаленные архивацией строки)
+    cursor.execute(
+        f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+        (last_id, chunk_size - 1)
+    )
+    row = cursor.fetchone()
+    return min(row[0], max_id) if row else max_id
+
+
+def step_sql(step):
+    return step if isinstance(step, str) else step.sql
+
+
+def migration_checksum(steps):
+    return hashlib.md5("\n".join(step_sql(step) for step in steps).encode()).hexdigest()
+
 
-def get_schema_version():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def create_migration_tables(cursor):
     cursor.execute('''
-        SELECT name FROM sqlite_master 
-        WHERE type='table' AND name='schema_migrations'
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version TEXT PRIMARY KEY,
+            description TEXT,
+            checksum TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
     ''')
-    if not cursor.fetchone():
-        conn.close()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS migration_progress (
+            version TEXT,
+            step INTEGER,
+            last_id INTEGER,
+            max_id INTEGER,
+            done BOOLEAN DEFAULT 0,
+            PRIMARY KEY (version, step)
+        )
+    ''')
+    ensure_column(cursor, 'migration_progress', 'max_id', 'INTEGER')
+
+
+def save_migration_progress(cursor, version, step, last_id=None, done=False, max_id=None):
+    cursor.execute('''
+        INSERT INTO migration_progress (version, step, last_id, max_id, done)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(version, step) DO UPDATE SET
+            last_id = COALESCE(excluded.last_id, last_id),
+            max_id = COALESCE(excluded.max_id, max_id),
+            done = excluded.done
+    ''', (version, step, last_id, max_id, done))
+
+
+def get_applied_migrations(db_name=None):
+    with transaction(db_name) as cursor:
+        create_migration_tables(cursor)
+        cursor.execute('SELECT version, checksum FROM schema_migrations')
+        return dict(cursor.fetchall())
+
+
+def get_schema_version(db_name=None):
+    applied = get_applied_migrations(db_name)
+    if not applied:
         return "0.0.0"
-    cursor.execute('SELECT version FROM schema_migrations ORDER BY applied_at DESC LIMIT 1')
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else "0.0.0"
+    return max(applied, key=parse_version)
 
-def apply_migration(version, sql_commands):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
 
+def apply_migration(version, steps, db_name=None):
     try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS schema_migrations (
-                version TEXT PRIMARY KEY,
-                description TEXT,
-                checksum TEXT,
-                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        cursor.execute('SELECT version FROM schema_migrations WHERE version = ?', (version,))
-        if cursor.fetchone():
+        if version in get_applied_migrations(db_name):
             print(f"Миграция {version} уже применена")
-            conn.close()
             return False
-        for sql in sql_commands:
-            cursor.execute(sql)
-        checksum = hashlib.md5("\n".join(sql_commands).encode()).hexdigest()
-        cursor.execute('''
-            INSERT INTO schema_migrations (version, description, checksum)
-            VALUES (?, ?, ?)
-        ''', (version, f"Миграция к версии {version}", checksum))
 
-        conn.commit()
+        cursor = get_connection(db_name).cursor()
+        cursor.execute('SELECT step, last_id, done FROM migration_progress WHERE version = ?', (version,))
+        progress = {step: (last_id, done) for step, last_id, done in cursor.fetchall()}
+        if progress:
+            print(f"Миграция {version}: продолжаем с сохраненного места")
+
+        for step_index, step in enumerate(steps):
+            last_id, done = progress.get(step_index, (None, False))
+            if done:
+                continue
+            if isinstance(step, CHUNKED_STEPS):
+                step.run(version, step_index, last_id or 0, db_name)
+            with transaction(db_name) as cursor:
+                if isinstance(step, str):
+                    cursor.execute(step)
+                elif isinstance(step, (AddColumn, CreateIndex)):
+                    step.apply(cursor)
+                save_migration_progress(cursor, version, step_index, done=True)
+
+        with transaction(db_name) as cursor:
+            cursor.execute('''
+                INSERT INTO schema_migrations (version, description, checksum)
+                VALUES (?, ?, ?)
+            ''', (version, f"Миграция к версии {version}", migration_checksum(steps)))
+            cursor.execute('DELETE FROM migration_progress WHERE version = ?', (version,))
+
         print(f"Миграция {version} успешно применена")
         return True
 
     except Exception as e:
-        conn.rollback()
         print(f"Ошибка применения миграции {version}: {e}")
         return False
-    finally:
-        conn.close()
 
 MIGRATIONS = {
+    # Текст шагов уже примененных миграций не меняется: от него зависит контрольная сумма
     "1.1.0": [
-        "ALTER TABLE users ADD COLUMN last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
-        "CREATE INDEX idx_users_last_activity ON users(last_activity DESC)",
+        AddColumn("users", "last_activity", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+        CreateIndex("idx_users_last_activity", "users(last_activity DESC)"),
     ],
     "1.2.0": [
-        "ALTER TABLE task_history ADD COLUMN time_spent INTEGER DEFAULT NULL",
-        "CREATE INDEX idx_task_history_time_spent ON task_history(time_spent) WHERE time_spent IS NOT NULL",
+        AddColumn("task_history", "time_spent", "INTEGER DEFAULT NULL"),
+        CreateIndex("idx_task_history_time_spent", "task_history(time_spent) WHERE time_spent IS NOT NULL"),
+    ],
+    "1.3.0": [
+        ChunkedInsert("task_history", """
+        INSERT OR IGNORE INTO user_task_summary (user_id, task_id, attempts, correct, last_seen)
+        SELECT user_id, task_id, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END), MAX(timestamp)
+        FROM task_history
+        GROUP BY user_id, task_id
+        """, '''
+            INSERT INTO user_task_summary (user_id, task_id, attempts, correct, last_seen)
+            SELECT user_id, task_id, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END), MAX(timestamp)
+            FROM task_history
+            WHERE rowid > ? AND rowid <= ?
+            GROUP BY user_id, task_id
+            ON CONFLICT (user_id, task_id) DO UPDATE SET
+                attempts = attempts + excluded.attempts,
+                correct = correct + excluded.correct,
+                last_seen = MAX(COALESCE(last_seen, ''), excluded.last_seen)
+        '''),
+    ],
+    "1.4.0": [
+        ChunkedInsert("task_history", """
+        INSERT OR IGNORE INTO daily_user_stats (user_id, day, tasks_per_day, correct_per_day)
+        SELECT user_id, DATE(timestamp), COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END)
+        FROM task_history
+        WHERE timestamp IS NOT NULL
+        GROUP BY user_id, DATE(timestamp)
+        """, '''
+            INSERT INTO daily_user_stats (user_id, day, tasks_per_day, correct_per_day)
+            SELECT user_id, DATE(timestamp), COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END)
+            FROM task_history
+            WHERE rowid > ? AND rowid <= ? AND timestamp IS NOT NULL
+            GROUP BY user_id, DATE(timestamp)
+            ON CONFLICT (user_id, day) DO UPDATE SET
+                tasks_per_day = tasks_per_day + excluded.tasks_per_day,
+                correct_per_day = correct_per_day + excluded.correct_per_day
+        '''),
+        ChunkedInsert("task_history", """
+        INSERT OR IGNORE INTO daily_topic_stats (topic, day, total_attempts, correct_attempts, difficulty_sum)
+        SELECT task_topic, DATE(timestamp), COUNT(*),
+               SUM(CASE WHEN correct THEN 1 ELSE 0 END), COALESCE(SUM(difficulty), 0)
+        FROM task_history
+        WHERE timestamp IS NOT NULL AND task_topic IS NOT NULL
+        GROUP BY task_topic, DATE(timestamp)
+        """, '''
+            INSERT INTO daily_topic_stats (topic, day, total_attempts, correct_attempts, difficulty_sum)
+            SELECT task_topic, DATE(timestamp), COUNT(*),
+                   SUM(CASE WHEN correct THEN 1 ELSE 0 END), COALESCE(SUM(difficulty), 0)
+            FROM task_history
+            WHERE rowid > ? AND rowid <= ? AND timestamp IS NOT NULL AND task_topic IS NOT NULL
+            GROUP BY task_topic, DATE(timestamp)
+            ON CONFLICT (topic, day) DO UPDATE SET
+                total_attempts = total_attempts + excluded.total_attempts,
+                correct_attempts = correct_attempts + excluded.correct_attempts,
+                difficulty_sum = difficulty_sum + excluded.difficulty_sum
+        '''),
+    ],
+    "1.5.0": [
+        # Данные переехали в сводные таблицы; они заполнятся при первом чтении
+        "DELETE FROM materialized_views",
+    ],
+    "1.6.0": [
+        # Индексы, которые не использует ни один запрос (см. index_audit.py)
+        "DROP INDEX IF EXISTS idx_task_history_user_task_time",
+        "DROP INDEX IF EXISTS idx_task_history_correct_true",
+        "DROP INDEX IF EXISTS idx_task_history_correct_false",
+        "DROP INDEX IF EXISTS idx_task_history_difficulty",
+        "DROP INDEX IF EXISTS idx_task_history_time_spent",
+    ],
+    "1.7.0": [
+        # Колонку day и индекс по ней добавляет create_schema; здесь заполняются старые строки
+        ChunkedBackfill("task_history", "day = DATE(timestamp)", "day IS NULL AND timestamp IS NOT NULL"),
+        "DROP INDEX IF EXISTS idx_task_history_user_correct_time",
+    ],
+    "1.8.0": [
+        # Колонки updated_at добавляет create_schema; здесь заполняются старые строки
+        ChunkedBackfill("users", "updated_at = COALESCE(last_activity, CURRENT_TIMESTAMP)", "updated_at IS NULL"),
+        ChunkedBackfill("topic_progress", "updated_at = COALESCE(last_solved, CURRENT_TIMESTAMP)", "updated_at IS NULL"),
     ],
 }
 
 
-def run_migrations():
-    current_version = get_schema_version()
+def run_migrations(defer_chunked=False):
+    # Все файлы (основная база и шарды) имеют одну схему и мигрируют одинаково
+    return all(migrate_database(db_name, defer_chunked) for db_name in all_db_names())
+
+
+def migrate_database(db_name=None, defer_chunked=False):
+    applied = get_applied_migrations(db_name)
+    current_version = max(applied, key=parse_version) if applied else "0.0.0"
     print(f"Текущая версия схемы: {current_version}")
-    for version, sql_commands in sorted(MIGRATIONS.items()):
-        if version > current_version:
-            print(f"Применяем миграцию {version}...")
-            apply_migration(version, sql_commands)
+
+    for version, checksum in applied.items():
+        steps = MIGRATIONS.get(version)
+        if steps is not None and checksum and checksum != migration_checksum(steps):
+            print(f"Контрольная сумма миграции {version} не совпадает с примененной, миграции остановлены")
+            return False
+
+    pending = [version for version in sorted(MIGRATIONS, key=parse_version) if version not in applied]
+    for index, version in enumerate(pending):
+        if defer_chunked and any(isinstance(step, CHUNKED_STEPS) for step in MIGRATIONS[version]):
+            # Порционная миграция и все следующие за ней идут в фоне (migrations_job)
+            fix_chunk_bounds(pending[index:], db_name)
+            print(f"Миграции начиная с {version} будут применены в фоне")
+            return True
+        print(f"Применяем миграцию {version}...")
+        if not apply_migration(version, MIGRATIONS[version], db_name):
+            # Следующие миграции могут зависеть от этой
+            return False
+    return True
+
+
+def fix_chunk_bounds(versions, db_name=None):
+    # Границы порций фиксируются до того, как бот начнет записывать ответы
+    with transaction(db_name) as cursor:
+        for version in versions:
+            for step_index, step in enumerate(MIGRATIONS[version]):
+                if isinstance(step, ChunkedInsert):
+                    step.fix_bound(cursor, version, step_index)
+
+
 init_database()
-run_migrations()
+# Быстрые миграции применяются при запуске, порционные - в фоне, пока бот работает
+run_migrations(defer_chunked=True)
 
 class AnswerState(StatesGroup):
     waiting_for_answer = State()
@@ -526,32 +1827,234 @@ ADAPTIVE_WEIGHTS = {
 
 w1, w2, w3, w4 = ADAPTIVE_WEIGHTS['level'], ADAPTIVE_WEIGHTS['topic'], ADAPTIVE_WEIGHTS['novelty'], ADAPTIVE_WEIGHTS['time']
 
-user_last_tasks = {}
+# Размер порции user_id в запросах IN (...) и число пользователей,
+# оцениваемых одной матрицей в пакетном подборе
+BATCH_QUERY_CHUNK = 500
+SCORING_CHUNK_USERS = 64
 
+# Сколько живет выданное задание; более старые строки current_tasks не читаются
+# и удаляются ночной задачей
+CURRENT_TASK_TTL = 24 * 3600
 
-def load_tasks():
+
+def set_last_task(user_id, task_id):
+    with transaction(shard_db_name(user_id)) as cursor:
+        cursor.execute('''
+            INSERT INTO current_tasks (user_id, task_id, assigned_at, answered_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP, NULL)
+            ON CONFLICT (user_id) DO UPDATE SET
+                task_id = excluded.task_id,
+                assigned_at = excluded.assigned_at,
+                answered_at = NULL
+        ''', (user_id, task_id))
+
+
+def get_last_task(user_id):
+    row = get_connection(shard_db_name(user_id)).execute('''
+        SELECT task_id FROM current_tasks
+        WHERE user_id = ? AND assigned_at >= datetime('now', ?)
+    ''', (user_id, f"-{CURRENT_TASK_TTL} seconds")).fetchone()
+    if row is None:
+        return None
+    return task_catalog.get(row[0])
+
+
+def has_pending_task(user_id):
+    row = get_connection(shard_db_name(user_id)).execute('''
+        SELECT 1 FROM current_tasks
+        WHERE user_id = ? AND answered_at IS NULL AND assigned_at >= datetime('now', ?)
+    ''', (user_id, f"-{CURRENT_TASK_TTL} seconds")).fetchone()
+    return row is not None
+
+
+def claim_task(user_id):
+    # Ответ принимается один раз: из нескольких воркеров, получивших сообщения
+    # с ответом, задание забирает только первый. Строка остается, чтобы после
+    # ответа работали /hint и /solution
+    with transaction(shard_db_name(user_id)) as cursor:
+        row = cursor.execute('''
+            SELECT task_id FROM current_tasks
+            WHERE user_id = ? AND answered_at IS NULL AND assigned_at >= datetime('now', ?)
+        ''', (user_id, f"-{CURRENT_TASK_TTL} seconds")).fetchone()
+        if row is not None:
+            cursor.execute(
+                "UPDATE current_tasks SET answered_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (user_id,)
+            )
+    if row is None:
+        return None
+    return task_catalog.get(row[0])
+
+
+def release_task(user_id, task_id):
+    # Ответ не удалось записать: задание снова ждет ответа
+    with transaction(shard_db_name(user_id)) as cursor:
+        cursor.execute(
+            "UPDATE current_tasks SET answered_at = NULL WHERE user_id = ? AND task_id = ?",
+            (user_id, task_id)
+        )
+
+
+def clear_last_task(user_id):
+    with transaction(shard_db_name(user_id)) as cursor:
+        cursor.execute("DELETE FROM current_tasks WHERE user_id = ?", (user_id,))
+
+
+def evict_expired_tasks(ttl=CURRENT_TASK_TTL):
+    evicted = 0
+    for db_name in shard_names():
+        with transaction(db_name) as cursor:
+            cursor.execute(
+                "DELETE FROM current_tasks WHERE assigned_at < datetime('now', ?)",
+                (f"-{ttl} seconds",)
+            )
+            evicted += cursor.rowcount
+    return evicted
+
+
+TASK_PATHS = [
+    'data/database.json',
+    'database.json',
+    '../data/database.json'
+]
+TASK_RELOAD_CHECK_INTERVAL = 1.0
+
+
+def task_difficulty(task):
     try:
-        possible_paths = [
-            'data/database.json',
-            'database.json',
-            '../data/database.json'
-        ]
-
-        for path in possible_paths:
-            if os.path.exists(path):
-                with open(path, 'r', encoding='utf-8') as f:
-                    tasks = json.load(f)
-                    for task in tasks:
-                        if 'difficulty' not in task:
-                            task['difficulty'] = estimate_difficulty(task)
-                    return tasks
-
-        print("Файл с заданиями не найден!")
-        return []
+        return int(task.get('difficulty', 1))
+    except (TypeError, ValueError):
+        return 1
 
-    except Exception as e:
-        print(f"Ошибка загрузки заданий: {e}")
-        return []
+
+class CatalogSnapshot:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.by_id = {}
+        self.by_topic = {}
+        self.by_difficulty = {}
+
+        for task in tasks:
+            self.by_id[task['id']] = task
+            self.by_topic.setdefault(task['topic'], []).append(task)
+            self.by_difficulty.setdefault(task_difficulty(task), []).append(task)
+
+        # Колоночное представление каталога для векторного подсчета рейтингов
+        self.id_index = {task['id']: i for i, task in enumerate(tasks)}
+        self.topic_names = list(self.by_topic)
+        self.topic_codes = {topic: code for code, topic in enumerate(self.topic_names)}
+        self.difficulty = np.array([task_difficulty(task) for task in tasks], dtype=np.int64)
+        self.topic_index = np.array([self.topic_codes[task['topic']] for task in tasks], dtype=np.int64)
+
+
+class TaskCatalog:
+    def __init__(self, paths=None, check_interval=TASK_RELOAD_CHECK_INTERVAL):
+        self.paths = list(TASK_PATHS if paths is None else paths)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = CatalogSnapshot([])
+        self._stamp = None
+        self._loaded = False
+        self._last_check = 0.0
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        catalog = cls(paths=[])
+        catalog._snapshot = CatalogSnapshot(prepare_tasks(tasks))
+        catalog._loaded = True
+        return catalog
+
+    def _file_stamp(self):
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return path, (path, st.st_mtime_ns, st.st_size)
+        return None, None
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if self._loaded and not force and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+
+        path, stamp = self._file_stamp()
+        if self._loaded and not force and stamp == self._stamp:
+            return False
+
+        with self._lock:
+            if self._loaded and not force and stamp == self._stamp:
+                return False
+
+            if path is None:
+                if not self.paths:
+                    return False
+                print("Файл с заданиями не найден!")
+                self._snapshot = CatalogSnapshot([])
+            else:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        snapshot = CatalogSnapshot(prepare_tasks(json.load(f)))
+                except Exception as e:
+                    # Оставляем прежний каталог, пока файл не будет исправлен
+                    print(f"Ошибка загрузки заданий: {e}")
+                    self._stamp = stamp
+                    self._loaded = True
+                    return False
+                self._snapshot = snapshot
+                print(f"Каталог заданий загружен: {len(snapshot.tasks)} шт.")
+
+            self._stamp = stamp
+            self._loaded = True
+            return True
+
+    @property
+    def snapshot(self):
+        self.refresh()
+        return self._snapshot
+
+    @property
+    def current(self):
+        # Для цикла событий: загруженный снимок без проверки файла. Файл
+        # перечитывается при обращениях из рабочих потоков
+        return self._snapshot
+
+    @property
+    def tasks(self):
+        return self.snapshot.tasks
+
+    def get(self, task_id):
+        return self.snapshot.by_id.get(task_id)
+
+    def by_topic(self, topic):
+        return self.snapshot.by_topic.get(topic, [])
+
+    def by_difficulty(self, difficulty):
+        return self.snapshot.by_difficulty.get(difficulty, [])
+
+    def topics(self):
+        return list(self.snapshot.by_topic)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+def prepare_tasks(tasks):
+    for task in tasks:
+        if 'difficulty' not in task:
+            task['difficulty'] = estimate_difficulty(task)
+    return tasks
+
+
+task_catalog = TaskCatalog()
+
+
+def load_tasks():
+    return task_catalog.tasks
 
 
 def estimate_difficulty(task):
@@ -570,9 +2073,140 @@ def estimate_difficulty(task):
         return random.randint(1, 2)
 
 
+USER_PROFILE_CACHE_SIZE = 10000
+USER_PROFILE_CACHE_TTL = 300
+RECENT_RESULTS_LIMIT = 10
+
+
+class UserProfileCache:
+    # Профили пользователей (статистика, темы, последние ответы) в памяти процесса.
+    # Каждое поле живет USER_PROFILE_CACHE_TTL секунд; запись ответа обновляет
+    # профиль на месте, поэтому повторные чтения в рамках одного ответа не идут в базу
+    def __init__(self, max_users=USER_PROFILE_CACHE_SIZE, ttl=USER_PROFILE_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        # Версии нужны только пользователям, чей профиль сейчас читается из базы:
+        # {user_id: [число идущих чтений, версия]}; _epoch меняет полный сброс
+        self._loads = {}
+        self._epoch = 0
+
+    def get(self, user_id, field, load):
+        now = time.monotonic()
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            cached = profile.get(field) if profile else None
+            if cached and now - cached[1] <= self.ttl:
+                self.hits += 1
+                self._profiles.move_to_end(user_id)
+                return copy_profile_field(cached[0])
+            self.misses += 1
+            load_state = self._loads.setdefault(user_id, [0, 0])
+            load_state[0] += 1
+            version = (self._epoch, load_state[1])
+
+        try:
+            value = load(user_id)
+        except BaseException:
+            with self._lock:
+                self._end_load(user_id, version)
+            raise
+        with self._lock:
+            # Пока шло чтение, запись ответа или сброс могли обновить профиль:
+            # прочитанное до них значение устарело и в кэш не кладется
+            if self._end_load(user_id, version):
+                self._put(user_id, field, value, time.monotonic())
+        return copy_profile_field(value)
+
+    def _end_load(self, user_id, version):
+        load_state = self._loads[user_id]
+        load_state[0] -= 1
+        if load_state[0] == 0:
+            del self._loads[user_id]
+        return version == (self._epoch, load_state[1])
+
+    def _bump_version(self, user_id):
+        load_state = self._loads.get(user_id)
+        if load_state is not None:
+            load_state[1] += 1
+
+    def put(self, user_id, field, value, now=None):
+        with self._lock:
+            self._put(user_id, field, value, now or time.monotonic())
+
+    def _put(self, user_id, field, value, now):
+        profile = self._profiles.setdefault(user_id, {})
+        profile[field] = (copy_profile_field(value), now)
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_users:
+            self._profiles.popitem(last=False)
+
+    def record_answers(self, user_id, stats, topics, answers):
+        # stats - состояние после последнего ответа, topics - {тема: (решено, доля верных)},
+        # answers - результаты ответов в порядке записи
+        now = time.monotonic()
+        with self._lock:
+            self._bump_version(user_id)
+            self._put(user_id, 'stats', stats, now)
+            profile = self._profiles[user_id]
+
+            cached_topics = profile.get('topics')
+            if cached_topics:
+                topic_stats = cached_topics[0]
+                for topic, (tasks_solved, correct_rate) in topics.items():
+                    topic_stats[topic] = {
+                        'correct_rate': correct_rate,
+                        'tasks_solved': tasks_solved,
+                        'weakness_score': 1.0 - correct_rate
+                    }
+
+            cached_recent = profile.get('recent')
+            if cached_recent:
+                recent = [bool(answer) for answer in reversed(answers)] + cached_recent[0]
+                profile['recent'] = (recent[:RECENT_RESULTS_LIMIT], cached_recent[1])
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._profiles.clear()
+                self._epoch += 1
+                return
+            for user_id in user_ids:
+                self._bump_version(user_id)
+                self._profiles.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._profiles),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+            }
+
+
+def copy_profile_field(value):
+    # Вызывающий код может менять результат; кэш отдает копии
+    if isinstance(value, dict):
+        return {key: dict(item) if isinstance(item, dict) else item for key, item in value.items()}
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+user_profile_cache = UserProfileCache()
+
+
 def get_user_stats(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    return user_profile_cache.get(user_id, 'stats', load_user_stats)
+
+
+def load_user_stats(user_id):
+    cursor = get_connection(shard_db_name(user_id)).cursor()
 
     cursor.execute('''
         SELECT total_tasks, correct_answers, current_level 
@@ -582,23 +2216,13 @@ def get_user_stats(user_id):
     result = cursor.fetchone()
 
     if result:
-        total_tasks, correct_answers, current_level = result
-
-        correct_rate = correct_answers / total_tasks if total_tasks > 0 else 0
-
-        stats = {
-            "total_tasks": total_tasks,
-            "correct_answers": correct_answers,
-            "correct_rate": correct_rate,
-            "current_level": current_level,
-            "level_name": DIFFICULTY_LEVELS.get(current_level, {}).get("name", "Новичок")
-        }
+        stats = make_user_stats(*result)
     else:
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, current_level) 
-            VALUES (?, 1)
-        ''', (user_id,))
-        conn.commit()
+        with transaction(shard_db_name(user_id)) as write_cursor:
+            write_cursor.execute('''
+                INSERT OR IGNORE INTO users (user_id, current_level, updated_at) 
+                VALUES (?, 1, CURRENT_TIMESTAMP)
+            ''', (user_id,))
 
         stats = {
             "total_tasks": 0,
@@ -608,12 +2232,14 @@ def get_user_stats(user_id):
             "level_name": "Новичок"
         }
 
-    conn.close()
     return stats
 
 def get_topic_stats(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    return user_profile_cache.get(user_id, 'topics', load_topic_stats)
+
+
+def load_topic_stats(user_id):
+    cursor = get_connection(shard_db_name(user_id)).cursor()
 
     cursor.execute('''
         SELECT topic, correct_rate, tasks_solved 
@@ -630,77 +2256,390 @@ def get_topic_stats(user_id):
             'weakness_score': 1.0 - correct_rate
         }
 
-    conn.close()
     return topics
 
 
+def get_recent_results(user_id, limit=RECENT_RESULTS_LIMIT):
+    if limit > RECENT_RESULTS_LIMIT:
+        return load_recent_results(user_id, limit)
+    return user_profile_cache.get(user_id, 'recent', load_recent_results)[:limit]
+
+
+def load_recent_results(user_id, limit=RECENT_RESULTS_LIMIT):
+    cursor = get_connection(shard_db_name(user_id)).cursor()
+    cursor.execute('''
+        SELECT correct FROM task_history 
+        WHERE user_id = ? 
+        ORDER BY timestamp DESC, id DESC LIMIT ?
+    ''', (user_id, limit))
+    results = [bool(row[0]) for row in cursor.fetchall()]
+    if len(results) < limit:
+        # Более старые ответы могли уйти в архив
+        results += read_archived_results(user_id, limit - len(results))
+    return results
+
+
+def get_leaderboard(limit=10):
+    # Каждый шард отдает свою первую десятку, общий топ собирается из них
+    rows = query_shards('''
+        SELECT user_id, correct_answers, total_tasks, current_level 
+        FROM users 
+        WHERE total_tasks > 0 
+        ORDER BY correct_answers DESC 
+        LIMIT ?
+    ''', (limit,), analytics=True)
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:limit]
+
+
 def get_adaptive_task(user_id):
-    tasks = load_tasks()
-    if not tasks:
+    _, top_tasks = rank_tasks(user_id, 3)
+    if not top_tasks:
         return None
 
+    return random.choice(top_tasks)
+
+
+def rank_tasks(user_id, top_n):
+    snapshot = task_catalog.snapshot
+    tasks = snapshot.tasks
     stats = get_user_stats(user_id)
     user_level = stats["current_level"]
     topic_stats = get_topic_stats(user_id)
+    fingerprint = ranking_fingerprint(user_level, topic_stats)
+    if not tasks:
+        return fingerprint, []
+
+    task_summary = get_task_summary(user_id)
+    ratings = compute_task_ratings(snapshot, user_level, topic_stats, task_summary)
+    return fingerprint, [tasks[i] for i in select_top_tasks(ratings, top_n)]
+
+
+def get_adaptive_tasks(user_ids):
+    ranked = rank_tasks_batch(user_ids, 3)
+    return {
+        user_id: random.choice(top_tasks) if top_tasks else None
+        for user_id, (_, top_tasks) in ranked.items()
+    }
+
+
+def rank_tasks_batch(user_ids, top_n):
+    user_ids = list(dict.fromkeys(user_ids))
+    snapshot = task_catalog.snapshot
+    levels, topic_stats, summaries = load_user_profiles(user_ids)
+
+    ranked = {}
+    for start in range(0, len(user_ids), SCORING_CHUNK_USERS):
+        chunk = user_ids[start:start + SCORING_CHUNK_USERS]
+        chunk_levels = [levels.get(user_id, 1) for user_id in chunk]
+        chunk_topics = [topic_stats.get(user_id, {}) for user_id in chunk]
+        ratings = compute_task_ratings_batch(
+            snapshot, chunk_levels, chunk_topics, [summaries.get(user_id, {}) for user_id in chunk]
+        )
+        for row, user_id in enumerate(chunk):
+            fingerprint = ranking_fingerprint(chunk_levels[row], chunk_topics[row])
+            ranked[user_id] = (fingerprint, [snapshot.tasks[i] for i in select_top_tasks(ratings[row], top_n)])
+
+    return ranked
+
+
+def load_user_profiles(user_ids):
+    levels = {}
+    topic_stats = {}
+    summaries = {}
+
+    for db_name, shard_user_ids in group_by_shard(user_ids).items():
+        load_shard_profiles(get_connection(db_name).cursor(), shard_user_ids, levels, topic_stats, summaries)
+
+    return levels, topic_stats, summaries
+
+
+def load_shard_profiles(cursor, user_ids, levels, topic_stats, summaries):
+    for start in range(0, len(user_ids), BATCH_QUERY_CHUNK):
+        chunk = user_ids[start:start + BATCH_QUERY_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+
+        cursor.execute(f'''
+            SELECT user_id, current_level FROM users
+            WHERE user_id IN ({placeholders})
+        ''', chunk)
+        levels.update(cursor.fetchall())
+
+        cursor.execute(f'''
+            SELECT user_id, topic, correct_rate, tasks_solved FROM topic_progress
+            WHERE user_id IN ({placeholders})
+        ''', chunk)
+        for user_id, topic, correct_rate, tasks_solved in cursor.fetchall():
+            topic_stats.setdefault(user_id, {})[topic] = {
+                'correct_rate': correct_rate,
+                'tasks_solved': tasks_solved,
+                'weakness_score': 1.0 - correct_rate
+            }
+
+        cursor.execute(f'''
+            SELECT user_id, task_id, attempts, last_seen FROM user_task_summary
+            WHERE user_id IN ({placeholders})
+        ''', chunk)
+        for user_id, task_id, attempts, last_seen in cursor.fetchall():
+            summaries.setdefault(user_id, {})[task_id] = (attempts, last_seen)
+
+
+def ranking_fingerprint(user_level, topic_stats):
+    # Слабость темы округляется до десятых: более мелкие сдвиги
+    # почти не меняют рейтинг и не должны сбрасывать очередь
+    return user_level, tuple(sorted(
+        (topic, round(topic_stat['weakness_score'], 1)) for topic, topic_stat in topic_stats.items()
+    ))
+
+
+def get_task_summary(user_id):
+    cursor = get_connection(shard_db_name(user_id)).cursor()
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
     cursor.execute('''
-        SELECT task_id, timestamp, correct 
-        FROM task_history 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC
+        SELECT task_id, attempts, last_seen
+        FROM user_task_summary
+        WHERE user_id = ?
     ''', (user_id,))
 
-    history = cursor.fetchall()
-    conn.close()
-    task_frequency = {}
-    for task_id, timestamp, correct in history:
-        task_frequency[task_id] = task_frequency.get(task_id, 0) + 1
+    return {task_id: (attempts, last_seen) for task_id, attempts, last_seen in cursor.fetchall()}
+
+
+def compute_task_ratings(snapshot, user_level, topic_stats, task_summary, now=None):
+    return compute_task_ratings_batch(snapshot, [user_level], [topic_stats], [task_summary], now)[0]
+
+
+def compute_task_ratings_batch(snapshot, user_levels, topic_stats_list, task_summaries, now=None):
+    users = len(user_levels)
+    n = len(snapshot.tasks)
+    now = now or datetime.now()
+
+    levels = np.asarray(user_levels, dtype=np.int64)[:, None]
+    s_level = np.maximum(0.0, 1.0 - np.abs(snapshot.difficulty[None, :] - levels) * 0.3)
+
+    topic_scores = np.ones((users, len(snapshot.topic_names)))
+    for row, topic_stats in enumerate(topic_stats_list):
+        for topic, topic_stat in topic_stats.items():
+            code = snapshot.topic_codes.get(topic)
+            if code is not None:
+                topic_scores[row, code] = 0.5 + topic_stat['weakness_score'] * 0.5
+    s_topic = topic_scores[:, snapshot.topic_index]
+
+    rows, cols, attempts, last_seen = [], [], [], []
+    for row, task_summary in enumerate(task_summaries):
+        for task_id, (task_attempts, task_last_seen) in task_summary.items():
+            i = snapshot.id_index.get(task_id)
+            if i is not None:
+                rows.append(row)
+                cols.append(i)
+                attempts.append(task_attempts)
+                last_seen.append(task_last_seen)
+
+    frequency = np.zeros((users, n))
+    frequency[rows, cols] = attempts
+    s_novelty = 1.0 / (1.0 + frequency * 0.5)
+
+    s_time = np.ones((users, n))
+    seen = [k for k, timestamp in enumerate(last_seen) if timestamp]
+    if seen:
+        last_days = days_since([last_seen[k] for k in seen], now)
+        s_time[[rows[k] for k in seen], [cols[k] for k in seen]] = np.minimum(1.0, last_days / 30.0)
+
+    return (
+            ADAPTIVE_WEIGHTS['level'] * s_level +
+            ADAPTIVE_WEIGHTS['topic'] * s_topic +
+            ADAPTIVE_WEIGHTS['novelty'] * s_novelty +
+            ADAPTIVE_WEIGHTS['time'] * s_time
+    )
 
-    task_ratings = []
 
-    for task in tasks:
-        task_difficulty = int(task['difficulty']) if isinstance(task['difficulty'], (int, float, str)) else 1
-        level_diff = abs(int(task['difficulty']) - user_level)
-        s_level = max(0, 1.0 - level_diff * 0.3)
-        topic = task['topic']
-        if topic in topic_stats:
-            weakness = topic_stats[topic]['weakness_score']
-            s_topic = 0.5 + weakness * 0.5
-        else:
-            s_topic = 1.0
-        freq = task_frequency.get(task['id'], 0)
-        s_novelty = 1.0 / (1.0 + freq * 0.5)
-        last_solved = None
-        for task_id, timestamp, correct in history:
-            if task_id == task['id']:
-                last_solved = timestamp
-                break
+def days_since(timestamps, now):
+    try:
+        parsed = np.array(timestamps, dtype='datetime64[us]')
+    except ValueError:
+        return np.array([(now - datetime.fromisoformat(ts)).days for ts in timestamps], dtype=np.int64)
+    return (np.datetime64(now, 'us') - parsed) // np.timedelta64(1, 'D')
 
-        if last_solved:
-            last_days = (datetime.now() - datetime.fromisoformat(last_solved)).days
-            s_time = min(1.0, last_days / 30.0)
-        else:
-            s_time = 1.0
-        w1, w2, w3, w4 = 0.4, 0.3, 0.2, 0.1
-
-        rating = (
-                w1 * s_level +
-                w2 * s_topic +
-                w3 * s_novelty +
-                w4 * s_time
+
+def select_top_tasks(ratings, top_n):
+    top_n = min(top_n, len(ratings))
+    if top_n == 0:
+        return []
+
+    # argpartition находит порог top_n за O(n); при равных рейтингах
+    # порядок каталога сохраняется, как при стабильной сортировке
+    if top_n < len(ratings):
+        part = np.argpartition(-ratings, top_n - 1)[:top_n]
+        candidates = np.flatnonzero(ratings >= ratings[part].min())
+    else:
+        candidates = np.arange(len(ratings))
+
+    order = candidates[np.argsort(-ratings[candidates], kind='stable')]
+    return order[:top_n].tolist()
+
+
+RECOMMENDATION_QUEUE_SIZE = 10
+RECOMMENDATION_QUEUE_MAX_USERS = 10000
+
+
+class RecommendationQueue:
+    def __init__(self, size=RECOMMENDATION_QUEUE_SIZE, max_users=RECOMMENDATION_QUEUE_MAX_USERS):
+        self.size = size
+        self.max_users = max_users
+        self._queues = OrderedDict()
+        self._refilling = set()
+        self._lock = threading.Lock()
+
+    def pop(self, user_id):
+        with self._lock:
+            entry = self._queues.get(user_id)
+            while entry and entry['task_ids']:
+                task_ids = entry['task_ids']
+                # Случайный выбор среди трех лучших, как в get_adaptive_task
+                task_id = task_ids.pop(random.randrange(min(3, len(task_ids))))
+                task = task_catalog.get(task_id)
+                if task:
+                    return task
+            return None
+
+    def refill(self, user_id):
+        fingerprint, ranked = rank_tasks(user_id, self.size)
+        self._store(user_id, fingerprint, ranked)
+
+    def warm(self, user_ids):
+        for user_id, (fingerprint, ranked) in rank_tasks_batch(user_ids, self.size).items():
+            self._store(user_id, fingerprint, ranked)
+
+    def _store(self, user_id, fingerprint, ranked):
+        with self._lock:
+            entry = self._queues.get(user_id)
+            if entry and entry['fingerprint'] == fingerprint and len(entry['task_ids']) >= 3:
+                self._queues.move_to_end(user_id)
+                return
+
+            self._queues[user_id] = {
+                'fingerprint': fingerprint,
+                'level': fingerprint[0],
+                'task_ids': [task['id'] for task in ranked],
+            }
+            self._queues.move_to_end(user_id)
+            while len(self._queues) > self.max_users:
+                self._queues.popitem(last=False)
+
+    def next_task(self, user_id):
+        task = self.pop(user_id)
+        if task is None:
+            self.refill(user_id)
+            task = self.pop(user_id)
+        return task
+
+    def record_answer(self, user_id, task_id, new_level):
+        with self._lock:
+            entry = self._queues.get(user_id)
+            if entry:
+                if entry['level'] != new_level:
+                    del self._queues[user_id]
+                elif task_id in entry['task_ids']:
+                    entry['task_ids'].remove(task_id)
+
+    def schedule_refill(self, user_id):
+        with self._lock:
+            if user_id in self._refilling:
+                return
+            self._refilling.add(user_id)
+
+        future = db.submit(self.refill, user_id)
+        future.add_done_callback(lambda f: self._refill_done(user_id, f))
+
+    def _refill_done(self, user_id, future):
+        with self._lock:
+            self._refilling.discard(user_id)
+        if future.exception():
+            print(f"Ошибка пополнения очереди заданий: {future.exception()}")
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._queues.clear()
+            else:
+                self._queues.pop(user_id, None)
+
+
+recommendation_queue = RecommendationQueue()
+
+DB_EXECUTOR_WORKERS = 4
+
+
+class AsyncDatabase:
+    # Все обращения к SQLite из обработчиков идут через пул потоков,
+    # чтобы медленный запрос не останавливал цикл событий
+    def __init__(self, workers=DB_EXECUTOR_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def settle(self, user_id):
+        # Чтение после собственной записи: ждем, пока ответы пользователя попадут в БД
+        future = answer_writer.pending_future(user_id)
+        if future is not None:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception:
+                pass
+
+    async def get_user_stats(self, user_id):
+        await self.settle(user_id)
+        return await self.run(get_user_stats, user_id)
+
+    async def submit_answer(self, user_id, task_id, answer, time_spent=None):
+        # То же, что submit_answer, но запись идет общей пачкой через answer_writer
+        task = task_catalog.current.by_id.get(task_id)
+        if not task:
+            return None
+        is_correct = check_answer(answer, task['correct_answer'])
+        result = await asyncio.wrap_future(
+            answer_writer.submit(user_id, task_id, is_correct, time_spent, with_old_level=True)
         )
+        return make_answer_result(task, is_correct, result)
 
-        task_ratings.append((rating, task))
+    async def get_last_task(self, user_id):
+        return await self.run(get_last_task, user_id)
 
-    task_ratings.sort(key=lambda x: x[0], reverse=True)
-    top_n = min(3, len(task_ratings))
-    if top_n == 0:
-        return None
+    async def set_last_task(self, user_id, task_id):
+        return await self.run(set_last_task, user_id, task_id)
 
-    top_tasks = [task for _, task in task_ratings[:top_n]]
-    return random.choice(top_tasks)
+    async def has_pending_task(self, user_id):
+        return await self.run(has_pending_task, user_id)
+
+    async def claim_task(self, user_id):
+        return await self.run(claim_task, user_id)
+
+    async def release_task(self, user_id, task_id):
+        return await self.run(release_task, user_id, task_id)
+
+    async def clear_last_task(self, user_id):
+        return await self.run(clear_last_task, user_id)
+
+    async def get_recent_results(self, user_id, limit=10):
+        await self.settle(user_id)
+        return await self.run(get_recent_results, user_id, limit)
+
+    async def get_leaderboard(self, limit=10):
+        return await self.run(get_leaderboard, limit)
+
+    async def next_task(self, user_id):
+        await self.settle(user_id)
+        return await self.run(recommendation_queue.next_task, user_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+db = AsyncDatabase()
 
 
 def normalize_answer(answer):
@@ -714,8 +2653,8 @@ def check_answer(user_answer, correct_answer):
 
 
 async def send_task_to_user(message, task, user_id, state):
-    user_last_tasks[user_id] = task
-    stats = get_user_stats(user_id)
+    await db.set_last_task(user_id, task['id'])
+    stats = await db.get_user_stats(user_id)
 
     try:
         level_info = f"Уровень: {stats['level_name']} ({stats['current_level']}/5)"
@@ -777,7 +2716,7 @@ async def send_task_to_user(message, task, user_id, state):
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
-    stats = get_user_stats(user_id)
+    stats = await db.get_user_stats(user_id)
 
     welcome_text = (
         f"Привет, {message.from_user.first_name}!\n\n"
@@ -802,7 +2741,7 @@ async def cmd_start(message: types.Message):
 async def cmd_task(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
 
-    task = get_adaptive_task(user_id)
+    task = await db.next_task(user_id)
 
     if not task:
         await message.answer("Задания временно недоступны. Попробуйте позже.")
@@ -814,7 +2753,7 @@ async def cmd_task(message: types.Message, state: FSMContext):
 @dp.message(Command("hint"))
 async def cmd_hint(message: types.Message):
     user_id = message.from_user.id
-    task = user_last_tasks.get(user_id)
+    task = await db.get_last_task(user_id)
 
     if task and task.get('hint'):
         await message.answer(f"Подсказка:\n\n{task['hint']}")
@@ -825,7 +2764,7 @@ async def cmd_hint(message: types.Message):
 @dp.message(Command("solution"))
 async def cmd_solution(message: types.Message):
     user_id = message.from_user.id
-    task = user_last_tasks.get(user_id)
+    task = await db.get_last_task(user_id)
 
     if task and task.get('solution'):
         solution = task['solution']
@@ -841,21 +2780,12 @@ async def cmd_solution(message: types.Message):
 @dp.message(Command("stats"))
 async def cmd_stats(message: types.Message):
     user_id = message.from_user.id
-    stats = get_user_stats(user_id)
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT correct FROM task_history 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC LIMIT 10
-    ''', (user_id,))
-
-    recent_results = cursor.fetchall()
-    conn.close()
+    stats = await db.get_user_stats(user_id)
+    recent_results = await db.get_recent_results(user_id)
 
     recent_chart = ""
-    for result in recent_results:
-        recent_chart += "✅" if result[0] else "❌"
+    for correct in recent_results:
+        recent_chart += "✅" if correct else "❌"
 
     stats_text = (
         f"Твоя статистика\n\n"
@@ -877,19 +2807,7 @@ async def cmd_stats(message: types.Message):
 
 @dp.message(Command("leaderboard"))
 async def cmd_leaderboard(message: types.Message):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT user_id, correct_answers, total_tasks, current_level 
-        FROM users 
-        WHERE total_tasks > 0 
-        ORDER BY correct_answers DESC 
-        LIMIT 10
-    ''')
-
-    leaders = cursor.fetchall()
-    conn.close()
+    leaders = await db.get_leaderboard()
 
     if not leaders:
         await message.answer("Таблица лидеров пока пуста!")
@@ -915,16 +2833,67 @@ async def cmd_leaderboard(message: types.Message):
     await message.answer(leaderboard_text, parse_mode="Markdown")
 
 
+@dp.message(Command("reload_tasks"))
+async def cmd_reload_tasks(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    await db.run(task_catalog.refresh, True)
+    await message.answer(f"Каталог заданий перезагружен: {len(task_catalog.current.tasks)} шт.")
+
+
+@dp.message(Command("task_info"))
+async def cmd_task_info(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    snapshot = task_catalog.current
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        difficulty_text = ", ".join(
+            f"{difficulty}: {len(tasks)}" for difficulty, tasks in sorted(snapshot.by_difficulty.items())
+        )
+        await message.answer(
+            f"Заданий в каталоге: {len(snapshot.tasks)}\n"
+            f"Тем: {len(snapshot.by_topic)}\n"
+            f"По сложности: {difficulty_text}"
+        )
+        return
+
+    task = snapshot.by_id.get(parts[1].strip())
+    if not task:
+        await message.answer("Задание не найдено.")
+        return
+
+    await message.answer(
+        f"Задание {task['id']}\n"
+        f"Тема: {task['topic']}\n"
+        f"Сложность: {task_difficulty(task)}\n"
+        f"Ответ: {task['correct_answer']}\n"
+        f"Заданий по теме: {len(snapshot.by_topic.get(task['topic'], []))}"
+    )
+
+
 @dp.message(Command("cancel"))
 async def cmd_cancel(message: types.Message, state: FSMContext):
+    await db.clear_last_task(message.from_user.id)
     await state.clear()
     await message.answer("Текущее задание отменено.")
 
 
-@dp.message(AnswerState.waiting_for_answer)
+async def awaiting_answer(message: types.Message, state: FSMContext):
+    # Задание, выданное этим процессом, видно по состоянию FSM без запроса к базе.
+    # MemoryStorage живет в памяти одного процесса и теряется при перезапуске,
+    # поэтому при пустом состоянии решает строка current_tasks
+    if await state.get_state() == AnswerState.waiting_for_answer.state:
+        return True
+    return await db.has_pending_task(message.from_user.id)
+
+
+@dp.message(awaiting_answer)
 async def handle_answer(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    task = user_last_tasks.get(user_id)
+    task = await db.claim_task(user_id)
 
     if not task:
         await message.answer("Сначала получите задание!")
@@ -932,10 +2901,27 @@ async def handle_answer(message: types.Message, state: FSMContext):
         return
 
     user_answer = message.text
-    is_correct = check_answer(user_answer, task['correct_answer'])
+    try:
+        result = await db.submit_answer(user_id, task['id'], user_answer)
+    except Exception as e:
+        # Например, база заблокирована ночным пересчетом дольше busy_timeout:
+        # ответ не потерян, задание снова ждет его
+        print(f"Ошибка записи ответа: {e}")
+        try:
+            await db.release_task(user_id, task['id'])
+        except Exception as e:
+            print(f"Ошибка возврата задания: {e}")
+        await message.answer("Не удалось сохранить ответ. Отправь его еще раз чуть позже.")
+        return
+
+    if result is None:
+        await message.answer("Сначала получите задание!")
+        await state.clear()
+        return
 
-    old_level = get_user_stats(user_id)["current_level"]
-    new_level = update_user_stats(user_id, task['id'], is_correct)
+    is_correct = result["is_correct"]
+    recommendation_queue.record_answer(user_id, task['id'], result["new_level"])
+    recommendation_queue.schedule_refill(user_id)
 
     if is_correct:
         response = (
@@ -943,8 +2929,8 @@ async def handle_answer(message: types.Message, state: FSMContext):
             f"Верный ответ: {task['correct_answer']}\n\n"
         )
 
-        if new_level > old_level:
-            response += f"Поздравляем! Ты перешел на уровень {new_level}!\n\n"
+        if result["level_up"]:
+            response += f"Поздравляем! Ты перешел на уровень {result['new_level']}!\n\n"
 
         response += "Отличная работа! Хочешь еще задание?"
     else:
@@ -1010,10 +2996,6 @@ async def handle_natural_language(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     text = message.text.lower()
 
-    current_state = await state.get_state()
-    if current_state == AnswerState.waiting_for_answer.state:
-        return
-
     if any(word in text for word in ["привет", "здравствуй"]):
         await cmd_start(message)
 
@@ -1021,14 +3003,14 @@ async def handle_natural_language(message: types.Message, state: FSMContext):
         await cmd_task(message, state)
 
     elif any(word in text for word in ["подсказ", "помоги", "не знаю", "не понимаю", "как решать"]):
-        task = user_last_tasks.get(user_id)
+        task = await db.get_last_task(user_id)
         if task and task.get('hint'):
             await message.answer(f"Подсказка:\n\n{task['hint']}")
         else:
             await message.answer("Сначала получите задание!")
 
     elif any(word in text for word in ["решен", "ответ", "объясни", "покажи решение", "как правильно"]):
-        task = user_last_tasks.get(user_id)
+        task = await db.get_last_task(user_id)
         if task and task.get('solution'):
             await message.answer(f"Решение:\n\n{task['solution']}")
         else:
@@ -1063,9 +3045,49 @@ async def handle_natural_language(message: types.Message, state: FSMContext):
             await message.answer(help_text)
 
 
+MATERIALIZED_VIEWS_REBUILD_INTERVAL = 24 * 3600
+
+
+async def migrations_job():
+    # Каждая порция - отдельная короткая транзакция, запись ответов идет между ними
+    if not await db.run(run_migrations):
+        print("Фоновые миграции не применены")
+
+
+async def materialized_views_job(migrations):
+    # Полный пересчет агрегатов не идет одновременно с их фоновым заполнением
+    await migrations
+    while True:
+        await asyncio.sleep(MATERIALIZED_VIEWS_REBUILD_INTERVAL)
+        await db.run(archive_task_history)
+        await db.run(evict_expired_tasks)
+        await view_refresher.rebuild()
+
+
+async def analytics_snapshot_job():
+    while True:
+        await db.run(take_analytics_snapshot)
+        await asyncio.sleep(ANALYTICS_SNAPSHOT_INTERVAL)
+
+
 async def main():
     print("Запущено")
-    await dp.start_polling(bot)
+    view_refresher.bind(asyncio.get_running_loop())
+    # Каталог загружается до первых обработчиков, которые читают его без перезагрузки
+    await db.run(task_catalog.refresh)
+    migrations_task = asyncio.create_task(migrations_job())
+    rebuild_task = asyncio.create_task(materialized_views_job(migrations_task))
+    snapshot_task = asyncio.create_task(analytics_snapshot_job())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        migrations_task.cancel()
+        rebuild_task.cancel()
+        snapshot_task.cancel()
+        answer_writer.stop()
+        view_refresher.shutdown()
+        db.shutdown()
+        close_connections()
 
 
 if __name__ == "__main__":
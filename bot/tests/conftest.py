@@ -11,7 +11,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from main import (
     init_database, get_user_stats, update_user_stats,
     get_adaptive_task, check_answer, normalize_answer,
-    load_tasks, DIFFICULTY_LEVELS
+    load_tasks, DIFFICULTY_LEVELS, TaskCatalog
 )
 
 
@@ -22,25 +22,35 @@ def event_loop():
     loop.close()
 
 
+def remove_db_files(db_name):
+    from main import archive_db_name, analytics_db_name
+
+    for name in (db_name, archive_db_name(db_name), analytics_db_name(db_name)):
+        for path in (name, f"{name}-wal", f"{name}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
 @pytest.fixture
 def test_db():
     test_db_name = "test_users_stats.db"
-    if os.path.exists(test_db_name):
-        os.remove(test_db_name)
+    remove_db_files(test_db_name)
 
     from main import DB_NAME as original_db_name
 
     import main
     main.DB_NAME = test_db_name
+    main.recommendation_queue.invalidate()
+    main.user_profile_cache.invalidate()
 
     init_database()
 
     yield test_db_name
 
+    main.close_connections()
     main.DB_NAME = original_db_name
 
-    if os.path.exists(test_db_name):
-        os.remove(test_db_name)
+    remove_db_files(test_db_name)
 
 
 @pytest.fixture
@@ -88,4 +98,5 @@ def mock_tasks(monkeypatch, sample_tasks):
         return sample_tasks
 
     monkeypatch.setattr("main.load_tasks", mock_load_tasks)
+    monkeypatch.setattr("main.task_catalog", TaskCatalog.from_tasks(sample_tasks))
     return sample_tasks
\ No newline at end of file
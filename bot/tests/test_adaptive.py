@@ -1,5 +1,34 @@
 import pytest
-from main import get_adaptive_task, update_user_stats, get_user_stats
+import random
+from datetime import datetime, timedelta
+from main import (
+    get_adaptive_task, update_user_stats, get_user_stats,
+    CatalogSnapshot, compute_task_ratings, get_task_summary, select_top_tasks, ADAPTIVE_WEIGHTS,
+    RecommendationQueue, rank_tasks, rank_tasks_batch, get_adaptive_tasks
+)
+
+
+def reference_ratings(tasks, user_level, topic_stats, task_frequency, last_solved, now):
+    ratings = []
+    for task in tasks:
+        s_level = max(0, 1.0 - abs(int(task['difficulty']) - user_level) * 0.3)
+        if task['topic'] in topic_stats:
+            s_topic = 0.5 + topic_stats[task['topic']]['weakness_score'] * 0.5
+        else:
+            s_topic = 1.0
+        s_novelty = 1.0 / (1.0 + task_frequency.get(task['id'], 0) * 0.5)
+        if task['id'] in last_solved:
+            last_days = (now - datetime.fromisoformat(last_solved[task['id']])).days
+            s_time = min(1.0, last_days / 30.0)
+        else:
+            s_time = 1.0
+        ratings.append(
+            ADAPTIVE_WEIGHTS['level'] * s_level +
+            ADAPTIVE_WEIGHTS['topic'] * s_topic +
+            ADAPTIVE_WEIGHTS['novelty'] * s_novelty +
+            ADAPTIVE_WEIGHTS['time'] * s_time
+        )
+    return ratings
 
 
 class TestAdaptiveAlgorithm:
@@ -60,4 +89,98 @@ class TestAdaptiveAlgorithm:
 
         assert len(topics_seen) >= 1
 
-        print(f"Разнообразие тем: {topics_seen}")
\ No newline at end of file
+        print(f"Разнообразие тем: {topics_seen}")
+
+class TestScoringEngine:
+
+    def test_vectorized_ratings_match_formula(self):
+        rng = random.Random(7)
+        topics = [f"Тема {i}" for i in range(12)]
+        tasks = [
+            {"id": str(i), "topic": rng.choice(topics), "difficulty": str(rng.randint(1, 5))}
+            for i in range(2000)
+        ]
+        snapshot = CatalogSnapshot(tasks)
+        now = datetime(2024, 5, 1, 12, 0, 0)
+        topic_stats = {
+            topic: {"weakness_score": rng.random()} for topic in topics[:8]
+        }
+        task_frequency = {str(rng.randrange(2000)): rng.randint(1, 4) for _ in range(300)}
+        last_solved = {
+            task_id: (now - timedelta(days=rng.randint(0, 60), hours=rng.randint(0, 23))).isoformat(sep=" ")
+            for task_id in task_frequency
+        }
+        task_summary = {
+            task_id: (task_frequency[task_id], last_solved[task_id]) for task_id in task_frequency
+        }
+
+        for user_level in range(1, 6):
+            expected = reference_ratings(tasks, user_level, topic_stats, task_frequency, last_solved, now)
+            ratings = compute_task_ratings(snapshot, user_level, topic_stats, task_summary, now)
+            assert ratings.tolist() == expected
+
+            expected_top = sorted(range(len(tasks)), key=lambda i: expected[i], reverse=True)[:3]
+            assert select_top_tasks(ratings, 3) == expected_top
+
+        print("Векторный подсчет совпадает с формулой ADAPTIVE_WEIGHTS")
+
+    def test_task_summary_aggregates_history(self, test_db, test_user_id, mock_tasks):
+        update_user_stats(test_user_id, "test_1", True)
+        update_user_stats(test_user_id, "test_1", False)
+        update_user_stats(test_user_id, "test_2", True)
+
+        summary = get_task_summary(test_user_id)
+
+        assert set(summary) == {"test_1", "test_2"}
+        assert summary["test_1"][0] == 2
+        assert summary["test_2"][0] == 1
+        assert summary["test_1"][1] is not None
+
+        print(f"Сводка по заданиям строится за один проход: {summary}")
+
+    def test_batch_ranking_matches_single_user(self, test_db, mock_tasks):
+        user_ids = [2001, 2002, 2003]
+        update_user_stats(2001, "test_1", True)
+        update_user_stats(2002, "test_2", False)
+        update_user_stats(2002, "test_3", True)
+
+        batch = rank_tasks_batch(user_ids, 3)
+        for user_id in user_ids:
+            fingerprint, ranked = rank_tasks(user_id, 3)
+            assert batch[user_id][0] == fingerprint
+            assert [t["id"] for t in batch[user_id][1]] == [t["id"] for t in ranked]
+
+        tasks = get_adaptive_tasks(user_ids)
+        assert set(tasks) == set(user_ids)
+        assert all(task is not None for task in tasks.values())
+
+        print("Пакетный подбор совпадает с подбором для одного пользователя")
+
+
+class TestRecommendationQueue:
+
+    def test_queue_pops_ranked_tasks(self, test_db, test_user_id, mock_tasks):
+        queue = RecommendationQueue(size=3)
+
+        seen = set()
+        for i in range(3):
+            task = queue.next_task(test_user_id)
+            assert task is not None
+            seen.add(task["id"])
+
+        assert seen == {"test_1", "test_2", "test_3"}
+
+        print("Очередь выдает задания без повторного ранжирования")
+
+    def test_queue_dropped_on_level_change(self, test_db, test_user_id, mock_tasks):
+        queue = RecommendationQueue(size=3)
+        queue.refill(test_user_id)
+        task = queue.pop(test_user_id)
+
+        queue.record_answer(test_user_id, task["id"], 1)
+        assert queue.pop(test_user_id) is not None
+
+        queue.record_answer(test_user_id, task["id"], 2)
+        assert queue.pop(test_user_id) is None
+
+        print("Очередь сбрасывается при смене уровня")
@@ -0,0 +1,94 @@
+import json
+import os
+import pytest
+from main import TaskCatalog
+
+
+class TestTaskCatalog:
+
+    def test_catalog_loads_once(self, tmp_path, sample_tasks):
+        path = tmp_path / "database.json"
+        path.write_text(json.dumps(sample_tasks, ensure_ascii=False), encoding="utf-8")
+        catalog = TaskCatalog(paths=[str(path)], check_interval=0)
+
+        first = catalog.tasks
+        second = catalog.tasks
+
+        assert first is second
+        assert len(catalog) == len(sample_tasks)
+
+        print("Каталог не перечитывается без изменений файла")
+
+    def test_catalog_reloads_on_change(self, tmp_path, sample_tasks):
+        path = tmp_path / "database.json"
+        path.write_text(json.dumps(sample_tasks, ensure_ascii=False), encoding="utf-8")
+        catalog = TaskCatalog(paths=[str(path)], check_interval=0)
+        assert len(catalog) == 3
+
+        path.write_text(json.dumps(sample_tasks[:2], ensure_ascii=False), encoding="utf-8")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        assert len(catalog) == 2
+
+        print("Каталог перезагружается при изменении файла")
+
+    def test_catalog_keeps_previous_on_broken_file(self, tmp_path, sample_tasks):
+        path = tmp_path / "database.json"
+        path.write_text(json.dumps(sample_tasks, ensure_ascii=False), encoding="utf-8")
+        catalog = TaskCatalog(paths=[str(path)], check_interval=0)
+        assert len(catalog) == 3
+
+        path.write_text("[{", encoding="utf-8")
+
+        assert len(catalog) == 3
+
+        print("Поврежденный файл не затирает каталог")
+
+    def test_catalog_indexes(self, sample_tasks):
+        catalog = TaskCatalog.from_tasks(sample_tasks)
+
+        assert catalog.get("test_2")["topic"] == "Логические выражения"
+        assert catalog.get("missing") is None
+        assert [t["id"] for t in catalog.by_topic("Алгоритмы")] == ["test_3"]
+        assert [t["id"] for t in catalog.by_difficulty(1)] == ["test_1"]
+        assert catalog.by_difficulty(5) == []
+
+        print("Индексы каталога по id, теме и сложности работают")
+
+    @pytest.mark.asyncio
+    async def test_event_loop_reads_do_not_reload(self, tmp_path, sample_tasks, monkeypatch):
+        import threading
+        from unittest.mock import AsyncMock
+        import main
+
+        path = tmp_path / "database.json"
+        path.write_text(json.dumps(sample_tasks, ensure_ascii=False), encoding="utf-8")
+        catalog = TaskCatalog(paths=[str(path)], check_interval=0)
+        catalog.refresh()
+        monkeypatch.setattr(main, "task_catalog", catalog)
+        monkeypatch.setattr(main, "ADMIN_IDS", {1})
+
+        loop_thread = threading.current_thread()
+        refresh_threads = []
+        original_refresh = catalog.refresh
+
+        def tracked_refresh(force=False):
+            refresh_threads.append(threading.current_thread())
+            return original_refresh(force)
+
+        monkeypatch.setattr(catalog, "refresh", tracked_refresh)
+        path.write_text(json.dumps(sample_tasks[:2], ensure_ascii=False), encoding="utf-8")
+
+        # Ответ на цикле событий читает загруженный снимок
+        assert catalog.current.by_id["test_3"]["topic"] == "Алгоритмы"
+        assert refresh_threads == []
+
+        message = AsyncMock()
+        message.from_user.id = 1
+        await main.cmd_reload_tasks(message)
+
+        assert message.answer.call_args.args[0] == "Каталог заданий перезагружен: 2 шт."
+        assert refresh_threads and loop_thread not in refresh_threads
+
+        print("Каталог перечитывается вне цикла событий")
@@ -1,4 +1,5 @@
 import pytest
+import json
 import sqlite3
 from datetime import datetime
 from main import update_user_stats, get_user_stats, init_database
@@ -55,4 +56,775 @@ class TestDatabase:
         elif stats["correct_rate"] >= 0.75:
             assert stats["current_level"] == 4
 
-        print(f"Уровень рассчитан корректно: {stats['current_level']} при {stats['correct_rate']:.0%}")
\ No newline at end of file
+        print(f"Уровень рассчитан корректно: {stats['current_level']} при {stats['correct_rate']:.0%}")
+
+    def test_task_summary_maintained_on_insert(self, test_db, test_user_id, mock_tasks):
+        update_user_stats(test_user_id, "test_1", True)
+        update_user_stats(test_user_id, "test_1", False)
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT attempts, correct, last_seen FROM user_task_summary
+            WHERE user_id = ? AND task_id = ?
+        ''', (test_user_id, "test_1"))
+        attempts, correct, last_seen = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) FROM task_history WHERE user_id = ?", (test_user_id,))
+        history_count = cursor.fetchone()[0]
+        conn.close()
+
+        assert attempts == history_count == 2
+        assert correct == 1
+        assert last_seen is not None
+
+        print("Сводка user_task_summary обновляется вместе с task_history")
+
+    def test_connection_reused_with_pragmas(self, test_db):
+        from main import get_connection
+
+        conn = get_connection()
+        assert get_connection() is conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+        print("Соединение переиспользуется, WAL и PRAGMA включены")
+
+    def test_transaction_rollback(self, test_db, test_user_id):
+        from main import transaction
+
+        get_user_stats(test_user_id)
+        with pytest.raises(RuntimeError):
+            with transaction() as cursor:
+                cursor.execute("UPDATE users SET total_tasks = 100 WHERE user_id = ?", (test_user_id,))
+                raise RuntimeError("сбой")
+
+        assert get_user_stats(test_user_id)["total_tasks"] == 0
+
+        print("Транзакция откатывается при ошибке")
+
+    def test_answer_writer_group_commit(self, test_db, mock_tasks):
+        from main import AnswerWriter
+
+        writer = AnswerWriter(flush_interval=0.05, batch_size=50)
+        futures = [
+            writer.submit(3000 + i % 4, f"test_{i % 3 + 1}", i % 2 == 0)
+            for i in range(20)
+        ]
+        results = [future.result(timeout=5) for future in futures]
+        writer.stop()
+
+        assert all(result is not None for result in results)
+        assert sum(get_user_stats(3000 + i)["total_tasks"] for i in range(4)) == 20
+        assert get_user_stats(3000)["correct_answers"] == 5
+
+        print("Ответы записываются пачками с ожиданием фиксации")
+
+    def test_answer_writer_flushes_on_stop(self, test_db, test_user_id, mock_tasks):
+        from main import AnswerWriter
+
+        writer = AnswerWriter(flush_interval=60, batch_size=1000)
+        future = writer.submit(test_user_id, "test_1", True)
+        writer.stop()
+
+        assert future.result(timeout=1)["total_tasks"] == 1
+        assert get_user_stats(test_user_id)["total_tasks"] == 1
+
+        print("Очередь ответов сбрасывается при остановке")
+
+    def test_submit_answer_returns_level_transition(self, test_db, test_user_id, mock_tasks):
+        from main import submit_answer
+
+        for _ in range(4):
+            update_user_stats(test_user_id, "test_1", True)
+
+        first = submit_answer(test_user_id, "test_1", " 42 ")
+        assert first["is_correct"] is True
+        assert (first["old_level"], first["new_level"], first["level_up"]) == (1, 5, True)
+        assert first["stats"]["total_tasks"] == 5
+
+        second = submit_answer(test_user_id, "test_2", "неверно")
+        assert second["is_correct"] is False
+        assert second["correct_answer"] == "yxwz"
+        assert second["old_level"] == 5
+        assert second["new_level"] == get_user_stats(test_user_id)["current_level"]
+        assert second["level_up"] is False
+
+        assert submit_answer(test_user_id, "unknown", "42") is None
+        assert get_user_stats(test_user_id)["total_tasks"] == 6
+
+        print("Проверка, запись и переход уровня за одну транзакцию")
+
+    def test_current_task_persists_and_expires(self, test_db, test_user_id, mock_tasks):
+        import main
+        from main import set_last_task, get_last_task, evict_expired_tasks
+
+        set_last_task(test_user_id, "test_1")
+        set_last_task(test_user_id, "test_2")
+        set_last_task(test_user_id + 1, "test_3")
+
+        # Состояние хранится в базе, а не в памяти процесса
+        main.close_connections()
+        assert get_last_task(test_user_id)["id"] == "test_2"
+        assert get_last_task(test_user_id + 2) is None
+
+        conn = sqlite3.connect(test_db)
+        conn.execute(
+            "UPDATE current_tasks SET assigned_at = datetime('now', '-2 days') WHERE user_id = ?",
+            (test_user_id + 1,)
+        )
+        conn.commit()
+        conn.close()
+
+        assert get_last_task(test_user_id + 1) is None
+        assert evict_expired_tasks() == 1
+        assert get_last_task(test_user_id)["id"] == "test_2"
+
+        print("Текущее задание переживает перезапуск и удаляется по TTL")
+
+    def test_task_claimed_once(self, test_db, test_user_id, mock_tasks):
+        from main import set_last_task, get_last_task, has_pending_task, claim_task, clear_last_task
+
+        assert claim_task(test_user_id) is None
+        set_last_task(test_user_id, "test_1")
+        assert has_pending_task(test_user_id)
+
+        assert claim_task(test_user_id)["id"] == "test_1"
+        assert claim_task(test_user_id) is None
+        assert not has_pending_task(test_user_id)
+        assert get_last_task(test_user_id)["id"] == "test_1"
+
+        # Новое задание снова ждет ответа
+        set_last_task(test_user_id, "test_2")
+        assert has_pending_task(test_user_id)
+        clear_last_task(test_user_id)
+        assert not has_pending_task(test_user_id)
+        assert get_last_task(test_user_id) is None
+
+        print("Ответ на задание принимается один раз")
+
+    def test_incremental_views_match_rebuild(self, test_db, mock_tasks):
+        from main import refresh_materialized_views, rebuild_materialized_views, get_materialized_view
+
+        for i in range(12):
+            update_user_stats(4000 + i % 3, f"test_{i % 3 + 1}", i % 4 != 0)
+
+        refresh_materialized_views()
+        incremental = {
+            name: get_materialized_view(name)
+            for name in ("user_stats_daily", "top_users_weekly", "global_topic_stats")
+        }
+
+        rebuild_materialized_views()
+        rebuilt = {
+            name: get_materialized_view(name)
+            for name in ("user_stats_daily", "top_users_weekly", "global_topic_stats")
+        }
+
+        key = lambda row: json.dumps(row, sort_keys=True, ensure_ascii=False)
+        for name in incremental:
+            assert sorted(incremental[name], key=key) == sorted(rebuilt[name], key=key)
+        assert sum(row["tasks_per_day"] for row in incremental["user_stats_daily"]) == 12
+        assert sum(row["total_attempts"] for row in incremental["global_topic_stats"]) == 12
+
+        print("Дельты дневных агрегатов совпадают с полным пересчетом")
+
+    def test_level_recalculation_cadence(self, test_db, mock_tasks):
+        user_id = 4200
+        levels = [update_user_stats(user_id, "test_1", True)["current_level"] for _ in range(5)]
+        # Пересчет на пятом ответе по счетчикам после него
+        assert levels == [1, 1, 1, 1, 5]
+
+        levels = [update_user_stats(user_id, "test_1", False)["current_level"] for _ in range(3)]
+        assert levels == [5, 5, 5]
+
+        # Первый ответ после часа бездействия тоже пересчитывает уровень: 5 из 9
+        conn = sqlite3.connect(test_db)
+        conn.execute(
+            "UPDATE users SET last_activity = datetime('now', '-2 hours') WHERE user_id = ?", (user_id,)
+        )
+        conn.commit()
+        conn.close()
+        assert update_user_stats(user_id, "test_1", False)["current_level"] == 2
+        assert update_user_stats(user_id, "test_1", True)["current_level"] == 3
+
+        print("Уровень пересчитывается на каждом пятом ответе и после перерыва")
+
+    def test_rebuild_counts_answers_written_during_staging(self, test_db, mock_tasks):
+        import main
+        from main import stage_shard_aggregates, swap_shard_aggregates
+
+        for i in range(6):
+            update_user_stats(4100 + i % 2, f"test_{i % 3 + 1}", i % 2 == 0)
+
+        # GROUP BY идет без блокировки записи: ответ между снимком и подменой
+        # учитывается досчетом по id, а не теряется и не удваивается
+        last_id = stage_shard_aggregates(test_db)
+        update_user_stats(4100, "test_2", True)
+        swap_shard_aggregates(test_db, last_id)
+
+        conn = sqlite3.connect(test_db)
+        users = conn.execute("SELECT SUM(tasks_per_day), SUM(correct_per_day) FROM daily_user_stats").fetchone()
+        topics = conn.execute("SELECT SUM(total_attempts), SUM(difficulty_sum) FROM daily_topic_stats").fetchone()
+        conn.close()
+        temp_tables = main.get_connection(test_db).execute("SELECT COUNT(*) FROM sqlite_temp_master").fetchone()[0]
+
+        assert users == (7, 4)
+        assert topics == (7, 1 * 2 + 3 * 3 + 4 * 2)
+        assert temp_tables == 0
+        assert main.get_user_stats(4100)["total_tasks"] == 4
+
+        print("Пересчет агрегатов учитывает ответы, записанные во время GROUP BY")
+
+    def test_summary_tables_lookups(self, test_db, mock_tasks):
+        from main import (
+            refresh_materialized_views, get_user_daily_stats, get_top_users, get_topic_global_stats
+        )
+
+        for i in range(6):
+            update_user_stats(5001, "test_1", True)
+        for i in range(3):
+            update_user_stats(5002, "test_2", i == 0)
+
+        daily = get_user_daily_stats(5001)
+        assert len(daily) == 1
+        assert daily[0]["tasks_per_day"] == 6
+        assert daily[0]["daily_accuracy"] == 1.0
+
+        refresh_materialized_views()
+        top = get_top_users(limit=2)
+        assert [row["user_id"] for row in top] == [5001, 5002]
+        assert top[0]["active_days"] == 1
+
+        topic = get_topic_global_stats("Логические выражения")
+        assert topic["total_attempts"] == 3
+        assert topic["correct_attempts"] == 1
+        assert get_topic_global_stats("Нет такой темы") is None
+
+        print("Сводные таблицы отвечают на точечные запросы")
+
+    def test_level_and_topic_progress_without_triggers(self, test_db, test_user_id, mock_tasks):
+        for i in range(5):
+            update_user_stats(test_user_id, "test_1", i != 0)
+
+        stats = get_user_stats(test_user_id)
+        assert stats["total_tasks"] == 5
+        assert stats["current_level"] == 4
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        triggers = cursor.fetchall()
+        cursor.execute(
+            "SELECT tasks_solved, correct_rate FROM topic_progress WHERE user_id = ? AND topic = ?",
+            (test_user_id, "Кодирование информации")
+        )
+        tasks_solved, correct_rate = cursor.fetchone()
+        conn.close()
+
+        assert triggers == []
+        assert tasks_solved == 5
+        assert correct_rate == pytest.approx(0.8)
+
+        print(f"Уровень {stats['current_level']} и прогресс по теме считаются без триггеров")
+
+    def test_task_history_keeps_only_used_indexes(self, test_db):
+        from main import apply_migration, MIGRATIONS
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute("CREATE INDEX idx_task_history_difficulty ON task_history(user_id, difficulty)")
+        conn.commit()
+        conn.close()
+
+        apply_migration("1.6.0", MIGRATIONS["1.6.0"])
+        apply_migration("1.7.0", MIGRATIONS["1.7.0"])
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = 'task_history' AND sql IS NOT NULL
+            ORDER BY name
+        ''')
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT correct FROM task_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
+        ''', (1, 5))
+        plan = " ".join(row[3] for row in cursor.fetchall())
+        conn.close()
+
+        assert indexes == ["idx_task_history_user_day", "idx_task_history_user_time"]
+        assert "idx_task_history_user_time" in plan
+
+        print(f"У task_history остались только используемые индексы: {indexes}")
+
+    def test_archival_keeps_user_facing_stats(self, test_db, test_user_id, mock_tasks):
+        from main import (
+            archive_task_history, archive_db_name, rebuild_materialized_views,
+            get_recent_results, get_user_daily_stats, get_topic_global_stats, refresh_materialized_views
+        )
+
+        for i in range(6):
+            update_user_stats(test_user_id, "test_1" if i % 2 else "test_2", i % 3 != 0, time_spent=30 + i)
+
+        conn = sqlite3.connect(test_db)
+        conn.execute("UPDATE task_history SET timestamp = datetime('now', '-400 days', '+' || id || ' seconds')")
+        conn.execute("UPDATE task_history SET day = DATE(timestamp)")
+        conn.commit()
+        daily_view = conn.execute("SELECT * FROM v_daily_stats ORDER BY user_id, day").fetchall()
+        topics_view = conn.execute("SELECT * FROM v_user_topics ORDER BY user_id, topic").fetchall()
+        conn.close()
+
+        rebuild_materialized_views()
+        recent = get_recent_results(test_user_id)
+        daily = get_user_daily_stats(test_user_id, days=1000)
+        topic = get_topic_global_stats("Кодирование информации")
+
+        assert archive_task_history(horizon_days=180, batch_size=4) == 6
+
+        conn = sqlite3.connect(test_db)
+        live_rows = conn.execute("SELECT COUNT(*) FROM task_history").fetchone()[0]
+        rollup_rows = conn.execute("SELECT SUM(attempts) FROM task_history_rollup").fetchone()[0]
+        assert conn.execute("SELECT * FROM v_daily_stats ORDER BY user_id, day").fetchall() == daily_view
+        assert conn.execute("SELECT * FROM v_user_topics ORDER BY user_id, topic").fetchall() == topics_view
+        conn.close()
+
+        archive = sqlite3.connect(archive_db_name(test_db))
+        archived_rows = archive.execute("SELECT COUNT(*) FROM task_history").fetchone()[0]
+        archive.close()
+
+        assert live_rows == 0
+        assert rollup_rows == 6
+        assert archived_rows == 6
+
+        rebuild_materialized_views()
+        refresh_materialized_views()
+        assert get_recent_results(test_user_id) == recent
+        assert get_user_daily_stats(test_user_id, days=1000) == daily
+        assert get_topic_global_stats("Кодирование информации") == topic
+
+        print(f"Заархивировано {archived_rows} строк, статистика не изменилась")
+
+    def test_day_bucket_column_and_backfill(self, test_db, test_user_id, mock_tasks):
+        from main import apply_migration, MIGRATIONS
+
+        update_user_stats(test_user_id, "test_1", True)
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute("SELECT day = DATE(timestamp) FROM task_history")
+        assert cursor.fetchone()[0] == 1
+
+        cursor.execute('''
+            INSERT INTO task_history (user_id, task_id, task_topic, correct, difficulty, timestamp)
+            VALUES (?, 'test_2', 'Логические выражения', 0, 2, '2024-01-15 10:00:00')
+        ''', (test_user_id,))
+        conn.commit()
+        conn.close()
+
+        apply_migration("1.7.0", MIGRATIONS["1.7.0"])
+
+        conn = sqlite3.connect(test_db)
+        cursor = conn.cursor()
+        cursor.execute("SELECT day FROM task_history WHERE task_id = 'test_2'")
+        backfilled = cursor.fetchone()[0]
+        cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT day, COUNT(*), SUM(correct) FROM task_history
+            WHERE user_id = ? AND day >= date('now', '-30 days')
+            GROUP BY day
+        ''', (test_user_id,))
+        plan = " ".join(row[3] for row in cursor.fetchall())
+        conn.close()
+
+        assert backfilled == "2024-01-15"
+        assert "idx_task_history_user_day" in plan
+        assert "TEMP B-TREE" not in plan
+
+        print(f"Колонка day заполнена миграцией, план: {plan}")
+
+    def test_migrations_ordered_by_version_tuple(self, test_db, monkeypatch):
+        import main
+        from main import parse_version, run_migrations, get_schema_version, get_applied_migrations
+
+        assert parse_version("1.10.0") > parse_version("1.2.0")
+
+        applied_order = []
+        migrations = {
+            "1.10.0": ["CREATE TABLE IF NOT EXISTS m_ten (id INTEGER)"],
+            "1.2.0": ["CREATE TABLE IF NOT EXISTS m_two (id INTEGER)"],
+            "1.9.0": ["CREATE TABLE IF NOT EXISTS m_nine (id INTEGER)"],
+        }
+        monkeypatch.setattr(main, "MIGRATIONS", migrations)
+        original_apply = main.apply_migration
+
+        def tracking_apply(version, steps, db_name=None):
+            applied_order.append(version)
+            return original_apply(version, steps, db_name)
+
+        monkeypatch.setattr(main, "apply_migration", tracking_apply)
+
+        assert run_migrations() is True
+        assert applied_order == ["1.2.0", "1.9.0", "1.10.0"]
+        assert get_schema_version() == "1.10.0"
+        assert set(get_applied_migrations()) == {"1.2.0", "1.9.0", "1.10.0"}
+
+        print(f"Миграции применены по порядку версий: {applied_order}")
+
+    def test_checksum_mismatch_stops_migrations(self, test_db, monkeypatch):
+        import main
+        from main import run_migrations, apply_migration, get_applied_migrations
+
+        assert apply_migration("2.0.0", ["CREATE TABLE IF NOT EXISTS m_first (id INTEGER)"])
+
+        monkeypatch.setattr(main, "MIGRATIONS", {
+            "2.0.0": ["CREATE TABLE IF NOT EXISTS m_first (id INTEGER, changed TEXT)"],
+            "2.1.0": ["CREATE TABLE IF NOT EXISTS m_second (id INTEGER)"],
+        })
+
+        assert run_migrations() is False
+        assert "2.1.0" not in get_applied_migrations()
+
+        print("Измененная примененная миграция останавливает применение новых")
+
+    def test_chunked_backfill_resumes_after_crash(self, test_db):
+        from main import apply_migration, ChunkedBackfill, get_connection
+
+        conn = get_connection()
+        conn.execute("CREATE TABLE backfill_target (id INTEGER PRIMARY KEY, value INTEGER, doubled INTEGER)")
+        conn.executemany("INSERT INTO backfill_target (id, value) VALUES (?, ?)", [(i, i) for i in range(1, 26)])
+
+        steps = [ChunkedBackfill("backfill_target", "doubled = value * 2", "doubled IS NULL", chunk_size=10)]
+
+        # Сбой после первой порции: прогресс сохранен, а данные второй порции испорчены
+        conn.execute('''
+            INSERT INTO migration_progress (version, step, last_id, done) VALUES ('3.0.0', 0, 10, 0)
+        ''')
+        conn.execute("UPDATE backfill_target SET doubled = -1 WHERE id <= 10")
+
+        assert apply_migration("3.0.0", steps)
+
+        rows = dict(conn.execute("SELECT id, doubled FROM backfill_target").fetchall())
+        progress = conn.execute("SELECT COUNT(*) FROM migration_progress").fetchone()[0]
+
+        assert all(rows[i] == -1 for i in range(1, 11))
+        assert all(rows[i] == i * 2 for i in range(11, 26))
+        assert progress == 0
+
+        print("Порционный backfill продолжился с сохраненного места")
+
+    def test_applied_migration_checksums_unchanged(self):
+        import hashlib
+        from main import MIGRATIONS, migration_checksum
+
+        # Текст, с которым 1.1.0 и 1.2.0 уже записаны в schema_migrations
+        applied = {
+            "1.1.0": [
+                "ALTER TABLE users ADD COLUMN last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+                "CREATE INDEX idx_users_last_activity ON users(last_activity DESC)",
+            ],
+            "1.2.0": [
+                "ALTER TABLE task_history ADD COLUMN time_spent INTEGER DEFAULT NULL",
+                "CREATE INDEX idx_task_history_time_spent ON task_history(time_spent) WHERE time_spent IS NOT NULL",
+            ],
+        }
+        for version, sql in applied.items():
+            assert migration_checksum(MIGRATIONS[version]) == hashlib.md5("\n".join(sql).encode()).hexdigest()
+
+        print("Контрольные суммы примененных миграций не изменились")
+
+    def test_chunked_migrations_run_after_startup(self, test_db, mock_tasks, monkeypatch):
+        import main
+        from main import run_migrations, get_applied_migrations, get_schema_version, get_connection
+
+        monkeypatch.setattr(main, "MIGRATION_CHUNK_SIZE", 3)
+        conn = get_connection()
+        # История, записанная до появления сводных таблиц
+        conn.execute("INSERT INTO users (user_id) VALUES (8000), (8001), (8002)")
+        conn.executemany('''
+            INSERT INTO task_history (user_id, task_id, task_topic, correct, difficulty, timestamp)
+            VALUES (?, ?, 'Алгоритмы', ?, 2, ?)
+        ''', [(8000 + i % 3, f"test_{i % 2 + 1}", i % 2, f"2024-02-0{i % 5 + 1} 10:00:00") for i in range(10)])
+
+        assert run_migrations(defer_chunked=True) is True
+        applied = get_applied_migrations()
+        assert {"1.1.0", "1.2.0"} <= set(applied)
+        assert "1.3.0" not in applied
+
+        # Ответы, записанные до завершения фоновой миграции, не считаются дважды
+        update_user_stats(8000, "test_1", True)
+        update_user_stats(8001, "test_2", False)
+
+        assert run_migrations() is True
+        assert get_schema_version() == max(main.MIGRATIONS, key=main.parse_version)
+
+        summary = conn.execute(
+            "SELECT user_id, task_id, attempts, correct FROM user_task_summary ORDER BY user_id, task_id"
+        ).fetchall()
+        expected = conn.execute('''
+            SELECT user_id, task_id, COUNT(*), SUM(CASE WHEN correct THEN 1 ELSE 0 END)
+            FROM task_history GROUP BY user_id, task_id ORDER BY user_id, task_id
+        ''').fetchall()
+        assert summary == expected
+
+        daily_total = conn.execute("SELECT SUM(tasks_per_day) FROM daily_user_stats").fetchone()[0]
+        topic_total = conn.execute("SELECT SUM(total_attempts) FROM daily_topic_stats").fetchone()[0]
+        assert daily_total == topic_total == 12
+
+        print("Порционные миграции догоняют историю в фоне без двойного учета")
+
+    def test_updated_at_backfill_with_sparse_user_ids(self, test_db, monkeypatch):
+        import main
+        from main import apply_migration, MIGRATIONS, get_connection
+
+        calls = []
+        original_bound = main.chunk_upper_bound
+
+        def counting_bound(*args):
+            calls.append(args)
+            return original_bound(*args)
+
+        monkeypatch.setattr(main, "chunk_upper_bound", counting_bound)
+        monkeypatch.setattr(main, "MIGRATION_CHUNK_SIZE", 2)
+
+        conn = get_connection()
+        user_ids = [5, 1_000_000_000, 5_000_000_000, 7_000_000_000]
+        conn.executemany(
+            "INSERT INTO users (user_id, last_activity, updated_at) VALUES (?, '2024-01-01 00:00:00', NULL)",
+            [(user_id,) for user_id in user_ids]
+        )
+
+        assert apply_migration("1.8.0", MIGRATIONS["1.8.0"])
+
+        rows = conn.execute("SELECT updated_at FROM users").fetchall()
+        assert rows == [("2024-01-01 00:00:00",)] * 4
+        # Порции идут по существующим строкам, а не по всему диапазону user_id
+        assert len(calls) == 2
+
+        print("updated_at заполнен порциями по разреженным user_id")
+
+    def test_sharded_storage_keeps_api(self, test_db, mock_tasks, monkeypatch):
+        import os
+        import main
+        from main import (
+            shard_names, shard_db_name, get_leaderboard, get_top_users, get_topic_global_stats,
+            rebuild_materialized_views, refresh_materialized_views, load_user_profiles
+        )
+
+        main.close_connections()
+        monkeypatch.setattr(main, "SHARD_COUNT", 3)
+        shards = shard_names()
+        try:
+            init_database()
+            assert main.run_migrations() is True
+
+            for user_id in range(1, 7):
+                for i in range(user_id):
+                    update_user_stats(user_id, "test_1", True)
+
+            for user_id in range(1, 7):
+                conn = sqlite3.connect(shard_db_name(user_id))
+                owners = {row[0] for row in conn.execute("SELECT user_id FROM users")}
+                conn.close()
+                assert user_id in owners
+                assert all(shard_db_name(owner) == shard_db_name(user_id) for owner in owners)
+
+            conn = sqlite3.connect(test_db)
+            main_users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            main_topics = conn.execute("SELECT COUNT(*) FROM daily_topic_stats").fetchone()[0]
+            conn.close()
+            assert main_users == 0
+            assert main_topics == 0
+            topic_total = 0
+            for name in shards:
+                conn = sqlite3.connect(name)
+                topic_total += conn.execute("SELECT COALESCE(SUM(total_attempts), 0) FROM daily_topic_stats").fetchone()[0]
+                conn.close()
+            assert topic_total == 21
+
+            assert get_user_stats(6)["total_tasks"] == 6
+            assert [row[0] for row in get_leaderboard(3)] == [6, 5, 4]
+            levels, _, summaries = load_user_profiles([1, 2, 3, 4])
+            assert set(levels) == {1, 2, 3, 4}
+            assert summaries[4]["test_1"][0] == 4
+
+            rebuild_materialized_views()
+            refresh_materialized_views()
+            assert [row["user_id"] for row in get_top_users(limit=3)] == [6, 5, 4]
+            assert get_topic_global_stats("Кодирование информации")["total_attempts"] == 21
+        finally:
+            main.close_connections()
+            for name in shards:
+                for path in (name, f"{name}-wal", f"{name}-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        print(f"Данные разнесены по {len(shards)} шардам, API не изменился")
+
+    def test_answer_writer_isolates_shards(self, test_db, mock_tasks, monkeypatch):
+        import os
+        import threading
+        import main
+        from main import AnswerWriter, shard_names
+
+        main.close_connections()
+        monkeypatch.setattr(main, "SHARD_COUNT", 2)
+        shards = shard_names()
+        writer_threads = set()
+        original_write = main.write_user_answers
+
+        def failing_write(cursor, rows):
+            writer_threads.add(threading.current_thread().name)
+            if any(row[0] % 2 for row in rows):
+                raise RuntimeError("шард недоступен")
+            return original_write(cursor, rows)
+
+        try:
+            init_database()
+            monkeypatch.setattr(main, "write_user_answers", failing_write)
+            writer = AnswerWriter(flush_interval=0.05, batch_size=50)
+            futures = {user_id: writer.submit(user_id, "test_1", True) for user_id in (10, 11, 12, 13)}
+            writer.stop()
+
+            # Ответы исправного шарда записаны, ошибка досталась только ответам другого
+            assert futures[10].result(timeout=5)["total_tasks"] == 1
+            assert futures[12].result(timeout=5)["total_tasks"] == 1
+            for user_id in (11, 13):
+                with pytest.raises(RuntimeError):
+                    futures[user_id].result(timeout=5)
+            assert len(writer_threads) == 2
+        finally:
+            main.close_connections()
+            for name in shards:
+                for path in (name, f"{name}-wal", f"{name}-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        print("Каждый шард пишет свой поток, ошибка одного не задевает другой")
+
+    def test_analytics_snapshot_serves_heavy_reads(self, test_db, mock_tasks, monkeypatch):
+        import os
+        import main
+        from main import take_analytics_snapshot, analytics_db_name, get_leaderboard, refresh_view, get_top_users
+
+        update_user_stats(7001, "test_1", True)
+        assert take_analytics_snapshot() == 1
+        assert os.path.exists(analytics_db_name(test_db))
+
+        # Неизменившаяся база не копируется заново
+        copied_at = os.path.getmtime(analytics_db_name(test_db))
+        assert take_analytics_snapshot() == 0
+        assert os.path.getmtime(analytics_db_name(test_db)) >= copied_at
+
+        # Запись после снимка не видна аналитическим чтениям, пока снимок свежий
+        update_user_stats(7002, "test_1", True)
+        update_user_stats(7002, "test_2", True)
+        assert [row[0] for row in get_leaderboard()] == [7001]
+        refresh_view('top_users_weekly')
+        assert [row["user_id"] for row in get_top_users()] == [7001]
+
+        conn = sqlite3.connect(f"file:{analytics_db_name(test_db)}?mode=ro", uri=True)
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        conn.close()
+        assert journal_mode == "delete"
+
+        # Снимок старше допустимого возраста не используется
+        monkeypatch.setattr(main, "ANALYTICS_SNAPSHOT_MAX_AGE", -1)
+        assert [row[0] for row in get_leaderboard()] == [7002, 7001]
+
+        monkeypatch.setattr(main, "ANALYTICS_SNAPSHOT_MAX_AGE", 300)
+        assert take_analytics_snapshot() == 1
+        assert [row[0] for row in get_leaderboard()] == [7002, 7001]
+
+        print("Тяжелые чтения идут в аналитический снимок с ограниченным возрастом")
+
+    def test_user_profile_cache_write_through(self, test_db, test_user_id, mock_tasks):
+        import main
+        from main import user_profile_cache, get_topic_stats, get_recent_results, UserProfileCache
+        from main import load_user_stats, load_topic_stats, load_recent_results
+
+        update_user_stats(test_user_id, "test_1", True)
+        get_topic_stats(test_user_id)
+        get_recent_results(test_user_id)
+
+        hits_before = user_profile_cache.hits
+        misses_before = user_profile_cache.misses
+        for is_correct in (False, True, True):
+            update_user_stats(test_user_id, "test_2", is_correct)
+
+        stats = get_user_stats(test_user_id)
+        topics = get_topic_stats(test_user_id)
+        recent = get_recent_results(test_user_id)
+        assert user_profile_cache.hits - hits_before == 3
+        assert user_profile_cache.misses == misses_before
+
+        # Данные из кэша совпадают с базой
+        assert stats == load_user_stats(test_user_id)
+        db_topics = load_topic_stats(test_user_id)
+        assert set(topics) == set(db_topics)
+        for topic, topic_stat in db_topics.items():
+            assert topics[topic] == pytest.approx(topic_stat)
+        assert recent == load_recent_results(test_user_id)
+        assert recent[:4] == [True, True, False, True]
+
+        # Изменение результата вызывающим кодом не портит кэш
+        stats["total_tasks"] = -1
+        assert get_user_stats(test_user_id)["total_tasks"] == 4
+
+        cache = UserProfileCache(max_users=2, ttl=0)
+        loads = []
+        loader = lambda user_id: loads.append(user_id) or {"user": user_id}
+        cache.get(1, 'stats', loader)
+        cache.get(1, 'stats', loader)
+        assert loads == [1, 1]
+        cache.ttl = 60
+        cache.get(2, 'stats', loader)
+        cache.get(3, 'stats', loader)
+        cache.get(1, 'stats', loader)
+        assert cache.stats()["size"] == 2
+        assert cache.stats()["misses"] == 5
+
+        print(f"Кэш профилей: {user_profile_cache.stats()}")
+
+    def test_user_profile_cache_drops_loads_raced_by_writes(self):
+        from main import UserProfileCache
+
+        cache = UserProfileCache(max_users=10, ttl=60)
+        fresh = {"total_tasks": 5}
+
+        # Ответ записан, пока профиль читался из базы: прочитанное значение старше
+        def stale_stats(user_id):
+            cache.record_answers(user_id, fresh, {}, [True])
+            return {"total_tasks": 4}
+
+        assert cache.get(1, 'stats', stale_stats) == {"total_tasks": 4}
+        assert cache.get(1, 'stats', lambda user_id: {"total_tasks": -1}) == fresh
+
+        # Сброс во время чтения тоже не дает положить старое значение
+        def reset_during_load(user_id):
+            cache.invalidate([user_id])
+            return {"total_tasks": 4}
+
+        loads = []
+        cache.get(2, 'stats', reset_during_load)
+        cache.get(2, 'stats', lambda user_id: loads.append(user_id) or {"total_tasks": 7})
+        assert loads == [2]
+
+        def full_reset_during_load(user_id):
+            cache.invalidate()
+            return {"total_tasks": 4}
+
+        cache.get(3, 'stats', full_reset_during_load)
+        assert cache.get(3, 'stats', lambda user_id: {"total_tasks": 8}) == {"total_tasks": 8}
+
+        # Ошибка чтения не оставляет незавершенных загрузок
+        def failing_load(user_id):
+            raise RuntimeError("БД недоступна")
+
+        with pytest.raises(RuntimeError):
+            cache.get(4, 'stats', failing_load)
+        assert cache._loads == {}
+
+        print("Кэш профилей не сохраняет значения, устаревшие во время чтения")
@@ -22,6 +22,109 @@ class TestIntegration:
 
         print("Сценарий /task работает")
 
+    @pytest.mark.asyncio
+    async def test_answer_flow_reports_level_up(self, test_db, test_user_id, mock_tasks):
+        import main
+
+        # Уровень пересчитывается на каждом пятом ответе - пятый дает хендлер
+        for _ in range(4):
+            main.update_user_stats(test_user_id, "test_1", True)
+
+        message = AsyncMock()
+        message.from_user.id = test_user_id
+        message.text = "/task"
+        state = MagicMock(spec=FSMContext)
+        await cmd_task(message, state)
+        task = main.get_last_task(test_user_id)
+
+        message.text = task["correct_answer"]
+        with patch.object(main.db, "get_user_stats", AsyncMock()) as stats_read:
+            await handle_answer(message, state)
+
+        response = message.answer.call_args.args[0]
+        assert response.startswith("Правильно!")
+        assert "Ты перешел на уровень" in response
+        stats_read.assert_not_called()
+        assert main.get_user_stats(test_user_id)["total_tasks"] == 5
+
+        print("Ответ записывается одним вызовом с переходом уровня")
+
+    @pytest.mark.asyncio
+    async def test_answer_expected_without_fsm_state(self, test_db, test_user_id, mock_tasks):
+        import main
+        from main import awaiting_answer, cmd_cancel
+
+        message = AsyncMock()
+        message.from_user.id = test_user_id
+        message.text = "/task"
+        await cmd_task(message, MagicMock(spec=FSMContext))
+        task = main.get_last_task(test_user_id)
+
+        # Ответ приходит в другой воркер или после перезапуска: состояние FSM пустое
+        fresh_state = MagicMock(spec=FSMContext)
+        fresh_state.get_state.return_value = None
+        assert await awaiting_answer(message, fresh_state)
+
+        message.text = task["correct_answer"]
+        await handle_answer(message, fresh_state)
+        assert message.answer.call_args.args[0].startswith("Правильно!")
+        assert main.get_user_stats(test_user_id)["total_tasks"] == 1
+
+        # Повторное сообщение уже не считается ответом, подсказка остается доступной
+        assert not await awaiting_answer(message, fresh_state)
+        await handle_answer(message, fresh_state)
+        assert message.answer.call_args.args[0] == "Сначала получите задание!"
+        assert main.get_user_stats(test_user_id)["total_tasks"] == 1
+        assert main.get_last_task(test_user_id)["id"] == task["id"]
+
+        message.text = "/task"
+        await cmd_task(message, fresh_state)
+        assert await awaiting_answer(message, fresh_state)
+        await cmd_cancel(message, fresh_state)
+        assert not await awaiting_answer(message, fresh_state)
+
+        # Задание выдано этим процессом: база не опрашивается
+        waiting_state = MagicMock(spec=FSMContext)
+        waiting_state.get_state.return_value = AnswerState.waiting_for_answer.state
+        with patch.object(main.db, "has_pending_task", AsyncMock()) as pending_read:
+            assert await awaiting_answer(message, waiting_state)
+        pending_read.assert_not_called()
+        assert main.get_last_task(test_user_id) is None
+
+        print("Ожидание ответа хранится в current_tasks и не зависит от FSM")
+
+    @pytest.mark.asyncio
+    async def test_failed_answer_write_keeps_task_pending(self, test_db, test_user_id, mock_tasks):
+        import sqlite3
+        import main
+        from main import awaiting_answer
+
+        message = AsyncMock()
+        message.from_user.id = test_user_id
+        message.text = "/task"
+        state = MagicMock(spec=FSMContext)
+        await cmd_task(message, state)
+        task = main.get_last_task(test_user_id)
+
+        def locked(cursor, rows):
+            raise sqlite3.OperationalError("database is locked")
+
+        message.text = task["correct_answer"]
+        with patch.object(main, "write_user_answers", locked):
+            await handle_answer(message, state)
+
+        assert message.answer.call_args.args[0].startswith("Не удалось сохранить ответ")
+        # Состояние FSM пустое, чтобы проверить строку current_tasks
+        state.get_state.return_value = None
+        assert await awaiting_answer(message, state)
+        assert main.get_user_stats(test_user_id)["total_tasks"] == 0
+
+        await handle_answer(message, state)
+        assert message.answer.call_args.args[0].startswith("Правильно!")
+        assert main.get_user_stats(test_user_id)["total_tasks"] == 1
+
+        print("Ответ, который не удалось записать, можно отправить еще раз")
+
     @pytest.mark.asyncio
     async def test_hint_and_solution_in_state(self):
         print("Команды помощи работают в нужном состоянии")
@@ -33,4 +136,180 @@ class TestIntegration:
             print("Интеграция с Rasa работает")
 
     def test_fsm_context_management(self):
-        print("FSM управляет состояниями корректно")
\ No newline at end of file
+        print("FSM управляет состояниями корректно")
+
+    @pytest.mark.asyncio
+    async def test_db_calls_do_not_block_loop(self, test_db, test_user_id):
+        import asyncio
+        import time
+        from main import db
+
+        def slow_query():
+            time.sleep(0.3)
+            return "готово"
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.ensure_future(ticker())
+        result = await db.run(slow_query)
+        stats = await db.get_user_stats(test_user_id)
+        ticker_task.cancel()
+
+        assert result == "готово"
+        assert stats["total_tasks"] == 0
+        assert ticks >= 10
+
+        print(f"Цикл событий не блокируется запросами к БД: {ticks} тиков")
+
+    @pytest.mark.asyncio
+    async def test_view_refresh_single_flight(self, test_db, monkeypatch):
+        import asyncio
+        import time
+        import main
+        from main import ViewRefreshCoordinator, refresh_view
+
+        calls = []
+
+        def slow_refresh(view_name):
+            calls.append(view_name)
+            time.sleep(0.2)
+            refresh_view(view_name)
+
+        monkeypatch.setattr(main, "refresh_view", slow_refresh)
+        coordinator = ViewRefreshCoordinator(ttl=0)
+
+        first = await asyncio.gather(*[coordinator.get("global_topic_stats") for _ in range(10)])
+        assert calls == ["global_topic_stats"]
+        assert all(result == [] for result in first)
+
+        await asyncio.sleep(1.1)
+        stale = await asyncio.gather(*[coordinator.get("global_topic_stats") for _ in range(10)])
+        await asyncio.sleep(0.3)
+
+        assert calls == ["global_topic_stats"] * 2
+        assert all(result == [] for result in stale)
+
+        print("Одновременные чтения запускают одно обновление представления")
+
+    @pytest.mark.asyncio
+    async def test_sync_view_reads_go_through_bound_loop(self, test_db, monkeypatch):
+        import asyncio
+        import time
+        import main
+        from main import ViewRefreshCoordinator, refresh_view, get_materialized_view
+
+        calls = []
+
+        def slow_refresh(view_name):
+            calls.append(view_name)
+            time.sleep(0.2)
+            refresh_view(view_name)
+
+        monkeypatch.setattr(main, "refresh_view", slow_refresh)
+        coordinator = ViewRefreshCoordinator(ttl=0)
+        coordinator.bind(asyncio.get_running_loop())
+        monkeypatch.setattr(main, "view_refresher", coordinator)
+
+        loop = asyncio.get_running_loop()
+        reads = [loop.run_in_executor(None, get_materialized_view, "global_topic_stats") for _ in range(5)]
+        assert await asyncio.gather(*reads) == [[]] * 5
+        assert calls == ["global_topic_stats"]
+
+        # Устаревшее представление из рабочего потока обновляется в цикле событий
+        await asyncio.sleep(1.1)
+        await loop.run_in_executor(None, get_materialized_view, "global_topic_stats")
+        await asyncio.sleep(0.3)
+        assert calls == ["global_topic_stats"] * 2
+
+        print("Синхронные чтения представлений используют общий координатор")
+
+    @pytest.mark.asyncio
+    async def test_missing_view_reads_from_db_pool_do_not_deadlock(self, test_db, monkeypatch):
+        import asyncio
+        import time
+        import main
+        from main import ViewRefreshCoordinator, refresh_view, get_materialized_view, db
+
+        def slow_refresh(view_name):
+            time.sleep(0.1)
+            refresh_view(view_name)
+
+        monkeypatch.setattr(main, "refresh_view", slow_refresh)
+        coordinator = ViewRefreshCoordinator(ttl=0)
+        coordinator.bind(asyncio.get_running_loop())
+        monkeypatch.setattr(main, "view_refresher", coordinator)
+
+        # Все потоки пула db ждут обновления, которое идет вне пула
+        reads = [db.run(get_materialized_view, "global_topic_stats") for _ in range(main.DB_EXECUTOR_WORKERS * 2)]
+        results = await asyncio.wait_for(asyncio.gather(*reads), timeout=10)
+        coordinator.shutdown()
+
+        assert all(result == [] for result in results)
+
+        print("Чтения из пула db не блокируют обновление представления")
+
+    @pytest.mark.asyncio
+    async def test_scheduled_rebuild_shares_refresh_thread(self, test_db, monkeypatch):
+        import asyncio
+        import threading
+        import time
+        import main
+        from main import ViewRefreshCoordinator
+
+        running = []
+        overlaps = []
+        calls = []
+        lock = threading.Lock()
+
+        def tracked(name):
+            def run(*args):
+                with lock:
+                    if running:
+                        overlaps.append(name)
+                    running.append(name)
+                calls.append(name)
+                time.sleep(0.1)
+                with lock:
+                    running.remove(name)
+            return run
+
+        monkeypatch.setattr(main, "rebuild_materialized_views", tracked("rebuild"))
+        monkeypatch.setattr(main, "refresh_view", tracked("refresh"))
+        coordinator = ViewRefreshCoordinator()
+
+        await asyncio.gather(
+            coordinator.rebuild(), coordinator.rebuild(), coordinator.refresh("top_users_weekly")
+        )
+        coordinator.shutdown()
+
+        assert sorted(calls) == ["rebuild", "refresh"]
+        assert overlaps == []
+
+        print("Плановый пересчет и обновления представлений идут по одному")
+
+    @pytest.mark.asyncio
+    async def test_view_refresh_backoff(self, test_db, monkeypatch):
+        import main
+        from main import ViewRefreshCoordinator
+
+        calls = []
+
+        def failing_refresh(view_name):
+            calls.append(view_name)
+            raise RuntimeError("БД недоступна")
+
+        monkeypatch.setattr(main, "refresh_view", failing_refresh)
+        coordinator = ViewRefreshCoordinator(backoff_base=60)
+
+        await coordinator.get("top_users_weekly")
+        await coordinator.get("top_users_weekly")
+
+        assert calls == ["top_users_weekly"]
+
+        print("После ошибки обновление откладывается")
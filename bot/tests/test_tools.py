@@ -0,0 +1,239 @@
+import pytest
+import csv
+import gzip
+import json
+import sqlite3
+from main import update_user_stats, get_user_stats, get_topic_stats, get_task_summary, get_user_daily_stats
+from import_history import import_history
+from export_data import export_all
+
+
+class TestImportHistory:
+
+    def test_import_jsonl_recomputes_user_state(self, test_db, test_user_id, mock_tasks, tmp_path):
+        update_user_stats(test_user_id, "test_1", True)
+
+        path = tmp_path / "history.jsonl"
+        records = [
+            {"user_id": test_user_id, "task_id": "test_1", "correct": True, "timestamp": "2024-03-01T10:00:00"},
+            {"user_id": test_user_id, "task_id": "test_2", "correct": False, "timestamp": "2024-03-01 10:05:00"},
+            {"user_id": 424242, "task_id": "test_2", "correct": "true", "timestamp": "2024-03-02 09:00:00",
+             "time_spent": 40},
+            {"user_id": 424242, "task_id": "unknown", "correct": True, "timestamp": "2024-03-02 09:01:00"},
+            {"user_id": 424242, "task_id": "test_1", "correct": True},
+        ]
+        path.write_text("\n".join(json.dumps(record) for record in records), encoding="utf-8")
+
+        imported, rejected = import_history(str(path), chunk_size=2)
+
+        assert imported == 3
+        assert rejected == 2
+
+        stats = get_user_stats(test_user_id)
+        assert stats["total_tasks"] == 3
+        assert stats["correct_answers"] == 2
+        assert get_task_summary(test_user_id)["test_1"][0] == 2
+        assert get_topic_stats(test_user_id)["Кодирование информации"]["tasks_solved"] == 2
+
+        new_user = get_user_stats(424242)
+        assert new_user["total_tasks"] == 1
+        assert new_user["current_level"] == 5
+        assert get_user_daily_stats(424242, days=100000)[0]["day"] == "2024-03-02"
+
+        conn = sqlite3.connect(test_db)
+        days = conn.execute("SELECT DISTINCT day FROM task_history ORDER BY day").fetchall()
+        conn.close()
+        assert days[0] == ("2024-03-01",)
+
+        print(f"Импортировано {imported} строк, отклонено {rejected}")
+
+    def test_import_csv(self, test_db, mock_tasks, tmp_path):
+        path = tmp_path / "history.csv"
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["user_id", "task_id", "correct", "timestamp", "time_spent"])
+            writer.writeheader()
+            for i in range(5):
+                writer.writerow({
+                    "user_id": 515151, "task_id": "test_1", "correct": "1" if i % 2 == 0 else "0",
+                    "timestamp": f"2024-04-0{i + 1} 12:00:00", "time_spent": ""
+                })
+
+        imported, rejected = import_history(str(path))
+
+        assert (imported, rejected) == (5, 0)
+        stats = get_user_stats(515151)
+        assert stats["total_tasks"] == 5
+        assert stats["correct_answers"] == 3
+        assert stats["current_level"] == 3
+
+        print("CSV импортирован, уровень пересчитан")
+
+    def test_import_rejects_bad_numbers_and_converts_to_utc(self, test_db, mock_tasks, tmp_path):
+        path = tmp_path / "history.jsonl"
+        records = [
+            {"user_id": 616161, "task_id": "test_1", "correct": True, "timestamp": "2024-05-01T12:00:00+03:00"},
+            {"user_id": 616161, "task_id": "test_1", "correct": True, "timestamp": "2024-05-01 10:00:00",
+             "time_spent": "12.5"},
+            {"user_id": 616161, "task_id": "other", "topic": "Алгоритмы", "difficulty": "2.5",
+             "correct": True, "timestamp": "2024-05-01 10:00:00"},
+            {"user_id": 616161, "task_id": "test_2", "correct": False, "timestamp": "2024-05-01T00:30:00+01:00"},
+            # Дробное число из JSON не округляется, нет или непонятен признак верности
+            {"user_id": 616161, "task_id": "test_1", "correct": True, "timestamp": "2024-05-01 10:00:00",
+             "time_spent": 12.5},
+            {"user_id": 616161, "task_id": "test_1", "timestamp": "2024-05-01 10:00:00"},
+            {"user_id": 616161, "task_id": "test_1", "correct": "maybe", "timestamp": "2024-05-01 10:00:00"},
+        ]
+        path.write_text("\n".join(json.dumps(record) for record in records), encoding="utf-8")
+
+        imported, rejected = import_history(str(path), chunk_size=1)
+
+        assert (imported, rejected) == (2, 5)
+        assert get_user_stats(616161)["total_tasks"] == 2
+
+        conn = sqlite3.connect(test_db)
+        rows = conn.execute("SELECT timestamp, day FROM task_history ORDER BY timestamp").fetchall()
+        conn.close()
+        assert rows == [("2024-04-30 23:30:00", "2024-04-30"), ("2024-05-01 09:00:00", "2024-05-01")]
+
+        print("Некорректные числа отклоняются, время приводится к UTC")
+
+    def test_recompute_in_user_chunks(self, test_db, mock_tasks, tmp_path, monkeypatch):
+        import import_history as importer
+
+        monkeypatch.setattr(importer, "RECOMPUTE_CHUNK_USERS", 2)
+        path = tmp_path / "history.jsonl"
+        records = [
+            {"user_id": 717100 + i % 5, "task_id": "test_1", "correct": i % 3 != 0,
+             "timestamp": "2024-06-01 10:00:00", "time_spent": 30.0}
+            for i in range(15)
+        ]
+        path.write_text("\n".join(json.dumps(record) for record in records), encoding="utf-8")
+
+        assert import_history(str(path)) == (15, 0)
+        for i in range(5):
+            stats = get_user_stats(717100 + i)
+            assert stats["total_tasks"] == 3
+            assert stats["correct_answers"] == sum(1 for j in range(i, 15, 5) if j % 3 != 0)
+
+        print("Итоги пересчитываются порциями пользователей")
+
+
+class TestExportData:
+
+    def test_incremental_export_by_watermark(self, test_db, test_user_id, mock_tasks, tmp_path):
+        update_user_stats(test_user_id, "test_1", True)
+        update_user_stats(test_user_id, "test_2", False)
+
+        first = export_all(str(tmp_path / "first"))
+        assert first[("task_history", test_db)] == 2
+        assert first[("users", test_db)] == 1
+
+        history_file = next((tmp_path / "first").glob("task_history_*.jsonl.gz"))
+        with gzip.open(history_file, "rt", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        assert [row["task_id"] for row in rows] == ["test_1", "test_2"]
+        assert rows[0]["task_topic"] == "Кодирование информации"
+
+        update_user_stats(test_user_id, "test_1", True)
+        second = export_all(str(tmp_path / "second"))
+        assert second[("task_history", test_db)] == 1
+
+        print("Повторная выгрузка содержит только новые строки")
+
+    def test_import_changes_are_exported_incrementally(self, test_db, test_user_id, mock_tasks, tmp_path):
+        update_user_stats(test_user_id, "test_1", True)
+        export_all(str(tmp_path / "first"))
+
+        # Импорт старой истории пересчитывает итоги, но не сдвигает last_activity
+        path = tmp_path / "history.jsonl"
+        path.write_text(json.dumps(
+            {"user_id": test_user_id, "task_id": "test_2", "correct": True, "timestamp": "2023-01-01 10:00:00"}
+        ), encoding="utf-8")
+        import_history(str(path))
+
+        second = export_all(str(tmp_path / "second"))
+        assert second[("users", test_db)] == 1
+        # Строка первой темы не изменилась и повторно не выгружается
+        assert second[("topic_progress", test_db)] == 1
+        topics_file = next((tmp_path / "second").glob("topic_progress_*.jsonl.gz"))
+        with gzip.open(topics_file, "rt", encoding="utf-8") as f:
+            assert [json.loads(line)["topic"] for line in f] == ["Логические выражения"]
+
+        users_file = next((tmp_path / "second").glob("users_*.jsonl.gz"))
+        with gzip.open(users_file, "rt", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        assert rows[0]["total_tasks"] == 2
+
+        print("Строки, пересчитанные импортом, попадают в следующую выгрузку")
+
+    def test_late_commits_are_not_skipped(self, test_db, test_user_id, mock_tasks, tmp_path):
+        update_user_stats(test_user_id, "test_1", True)
+        first = export_all(str(tmp_path / "first"))
+        assert first[("users", test_db)] == 1
+
+        # Транзакция поставила updated_at раньше прошлой выгрузки, но завершилась после нее
+        conn = sqlite3.connect(test_db)
+        conn.execute('''
+            INSERT INTO users (user_id, total_tasks, updated_at)
+            VALUES (?, 1, datetime('now', '-60 seconds'))
+        ''', (test_user_id + 1,))
+        conn.commit()
+        conn.close()
+
+        second = export_all(str(tmp_path / "second"))
+        assert second[("users", test_db)] == 1
+        users_file = next((tmp_path / "second").glob("users_*.jsonl.gz"))
+        with gzip.open(users_file, "rt", encoding="utf-8") as f:
+            assert [json.loads(line)["user_id"] for line in f] == [test_user_id + 1]
+
+        # Уже выгруженные строки из окна перекрытия не повторяются
+        third = export_all(str(tmp_path / "third"))
+        assert third[("users", test_db)] == 0
+        assert third[("topic_progress", test_db)] == 0
+
+        print("Строки, записанные до водяного знака, но завершенные позже, выгружаются")
+
+    def test_full_csv_export(self, test_db, test_user_id, mock_tasks, tmp_path):
+        for i in range(3):
+            update_user_stats(test_user_id, "test_1", i % 2 == 0)
+        export_all(str(tmp_path / "incremental"))
+
+        exported = export_all(str(tmp_path / "full"), "csv", full=True)
+        assert exported[("task_history", test_db)] == 3
+
+        history_file = next((tmp_path / "full").glob("task_history_*.csv.gz"))
+        with gzip.open(history_file, "rt", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 3
+        assert set(rows[0]) >= {"id", "user_id", "task_id", "correct", "timestamp", "day"}
+
+        print("Полная выгрузка в CSV игнорирует водяной знак")
+
+
+class TestCompactDatabases:
+
+    def test_legacy_database_converted_offline(self, test_db, test_user_id, mock_tasks):
+        import main
+        from compact_databases import compact_databases
+
+        main.close_connections()
+        conn = sqlite3.connect(test_db)
+        conn.execute("PRAGMA auto_vacuum = NONE")
+        conn.execute("VACUUM")
+        conn.close()
+
+        # Ночная задача не запускает полный VACUUM на рабочей базе
+        conn = main.open_connection(test_db)
+        assert not main.reclaim_free_pages(conn)
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+        conn.close()
+
+        assert compact_databases() == 1
+        assert compact_databases() == 0
+
+        conn = main.open_connection(test_db)
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert main.reclaim_free_pages(conn)
+        conn.close()
+
+        print("Старая база переводится в режим INCREMENTAL отдельным скриптом")